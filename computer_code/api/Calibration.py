@@ -0,0 +1,81 @@
+import numpy as np
+from scipy import linalg
+
+
+# swaps y and z, the last step of the conversion to world coordinates
+SWAP_YZ = np.array([[1,0,0,0],[0,0,1,0],[0,1,0,0],[0,0,0,1]], dtype=np.float64)
+# flips x and y, the first step of the conversion to world coordinates
+FLIP_XY = np.diag([-1.0, -1.0, 1.0, 1.0])
+
+
+class Calibration:
+    """
+    Everything the live pipeline derives from the camera intrinsics, camera
+    poses and the world transform, computed once. Instances are immutable,
+    when any input changes a new Calibration is built and swapped in.
+
+    Fs[i][j] maps an image point in camera i to its epipolar line in camera j
+    and epipoles[i][j] is the image of camera i's centre in camera j.
+
+    """
+
+    def __init__(self, intrinsic_matrices, camera_poses, to_world_coords_matrix=None):
+        self.num_cameras = len(camera_poses)
+
+        self.intrinsic_matrices = np.array(intrinsic_matrices[:self.num_cameras], dtype=np.float64)
+        self.inverse_intrinsic_matrices = np.linalg.inv(self.intrinsic_matrices)
+        self.camera_poses = [{
+            "R": np.array(camera_pose["R"], dtype=np.float64),
+            "t": np.array(camera_pose["t"], dtype=np.float64).reshape((3,))
+        } for camera_pose in camera_poses]
+
+        self.Ps = np.array([K @ np.c_[camera_pose["R"], camera_pose["t"]] for K, camera_pose in zip(self.intrinsic_matrices, self.camera_poses)])
+        self.camera_centers = np.array([-camera_pose["R"].T @ camera_pose["t"] for camera_pose in self.camera_poses])
+
+        self.epipoles = np.einsum("jab,ib->ija", self.Ps, np.c_[self.camera_centers, np.ones(self.num_cameras)])
+        self.Fs = np.zeros((self.num_cameras, self.num_cameras, 3, 3))
+        for i in range(0, self.num_cameras):
+            P_i_pinv = linalg.pinv(self.Ps[i])
+            for j in range(0, self.num_cameras):
+                if i == j:
+                    continue
+                F = cross_product_matrix(self.epipoles[i][j]) @ self.Ps[j] @ P_i_pinv
+                self.Fs[i][j] = F / linalg.norm(F)
+
+        self.to_world_coords_matrix = np.eye(4)
+        if to_world_coords_matrix is not None:
+            self.to_world_coords_matrix = np.array(to_world_coords_matrix, dtype=np.float64)
+        self.object_to_world_matrix = SWAP_YZ @ self.to_world_coords_matrix @ FLIP_XY
+
+        for array in [self.intrinsic_matrices, self.inverse_intrinsic_matrices, self.Ps, self.camera_centers, self.epipoles, self.Fs, self.to_world_coords_matrix, self.object_to_world_matrix]:
+            array.setflags(write=False)
+        for camera_pose in self.camera_poses:
+            camera_pose["R"].setflags(write=False)
+            camera_pose["t"].setflags(write=False)
+
+    def epipolar_lines(self, image_points, from_camera, to_camera):
+        # lines a*x + b*y + c = 0 normalized so a^2 + b^2 = 1, same as cv.computeCorrespondEpilines
+        image_points = np.array(image_points, dtype=np.float64).reshape((-1, 2))
+        lines = np.c_[image_points, np.ones(len(image_points))] @ self.Fs[from_camera][to_camera].T
+
+        return lines / np.hypot(lines[:, 0], lines[:, 1])[:, np.newaxis]
+
+    def object_points_to_world(self, object_points):
+        object_points = np.array(object_points, dtype=np.float64).reshape((-1, 3))
+        world_points = np.c_[object_points, np.ones(len(object_points))] @ self.object_to_world_matrix.T
+
+        return world_points[:, :3] / world_points[:, 3:]
+
+    def world_to_object_points(self, world_points):
+        world_points = np.array(world_points, dtype=np.float64).reshape((-1, 3))
+        object_points = np.c_[world_points, np.ones(len(world_points))] @ linalg.inv(self.object_to_world_matrix).T
+
+        return object_points[:, :3] / object_points[:, 3:]
+
+
+def cross_product_matrix(v):
+    return np.array([
+        [0, -v[2], v[1]],
+        [v[2], 0, -v[0]],
+        [-v[1], v[0], 0]
+    ])
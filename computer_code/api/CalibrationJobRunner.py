@@ -0,0 +1,115 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+# thread pools of the numeric libraries in the job process are limited to the cpu budget
+THREAD_ENV_VARS = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "NUMEXPR_NUM_THREADS", "VECLIB_MAXIMUM_THREADS", "MOCAP_CPU_BUDGET"]
+
+
+class CalibrationJobRunner:
+    """
+    Runs camera pose calibration in a separate low priority process so the
+    Socket.IO handlers and the tracking loop keep running while it solves.
+
+    One job runs at a time, starting a new one cancels the previous job.
+    on_event is called from a watcher thread with dicts holding the jobId and
+    a type of started, progress, done, cancelled or failed.
+
+    """
+
+    def __init__(self, on_event, cpu_budget=1, niceness=10):
+        self.on_event = on_event
+        self.cpu_budget = max(1, cpu_budget)
+        self.niceness = niceness
+
+        self.job = None
+        self.lock = threading.Lock()
+
+    def start(self, image_points, intrinsic_matrices, image_sizes, target_sample_count=1000):
+        self.cancel()
+
+        env = dict(os.environ)
+        for var in THREAD_ENV_VARS:
+            env[var] = str(self.cpu_budget)
+        # applied by calibration_job.py itself, a preexec_fn is not safe to run from a threaded process
+        env["MOCAP_CALIBRATION_NICENESS"] = str(self.niceness)
+        if hasattr(os, "sched_getaffinity"):
+            # keep it off the cores the tracking loop is busy on
+            cpus = sorted(os.sched_getaffinity(0))
+            env["MOCAP_CALIBRATION_CPU_SET"] = ",".join(str(cpu) for cpu in cpus[-self.cpu_budget:])
+
+        dirname = os.path.dirname(os.path.abspath(__file__))
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(dirname, "calibration_job.py")],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            cwd=dirname,
+            env=env,
+            text=True
+        )
+
+        job = {
+            "id": uuid.uuid4().hex[:8],
+            "process": process,
+            "start_time": time.time(),
+            "is_cancelled": False,
+            "is_finished": False
+        }
+        with self.lock:
+            self.job = job
+
+        self.on_event({"jobId": job["id"], "type": "started"})
+        threading.Thread(target=self._watch, args=(job, image_points, intrinsic_matrices, image_sizes, target_sample_count), name="calibration-job", daemon=True).start()
+
+        return job["id"]
+
+    def cancel(self, job_id=None):
+        with self.lock:
+            job = self.job
+            if job is None or job["is_finished"] or (job_id is not None and job_id != job["id"]):
+                return False
+            job["is_cancelled"] = True
+            self.job = None
+
+        job["process"].terminate()
+        return True
+
+    def _watch(self, job, image_points, intrinsic_matrices, image_sizes, target_sample_count):
+        process = job["process"]
+
+        try:
+            process.stdin.write(json.dumps({
+                "image_points": image_points,
+                "intrinsic_matrices": intrinsic_matrices,
+                "image_sizes": image_sizes,
+                "target_sample_count": target_sample_count
+            }))
+            process.stdin.close()
+
+            for line in process.stdout:
+                event = json.loads(line)
+                with self.lock:
+                    job["is_finished"] = job["is_finished"] or (event["type"] in ["done", "failed"] and not job["is_cancelled"])
+                if not job["is_cancelled"]:
+                    self.on_event({"jobId": job["id"], "elapsed": round(time.time() - job["start_time"], 2), **event})
+        except (BrokenPipeError, ValueError):
+            pass
+
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+        if job["is_cancelled"]:
+            self.on_event({"jobId": job["id"], "type": "cancelled"})
+        elif not job["is_finished"]:
+            self.on_event({"jobId": job["id"], "type": "failed", "message": f"calibration process exited with code {process.returncode}"})
+
+        with self.lock:
+            if self.job is job:
+                self.job = None
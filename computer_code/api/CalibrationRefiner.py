@@ -0,0 +1,125 @@
+import collections
+import threading
+import time
+import traceback
+
+import numpy as np
+from scipy.spatial.transform import Rotation
+
+from helpers import bundle_adjustment, image_points_to_array, triangulate_points_batch, reprojection_errors_batch, get_projection_matrices
+
+
+class CalibrationRefiner:
+    """
+    Refines the camera poses while tracking. Confident multi-camera
+    correspondences from the live frames are kept in a sliding window, and
+    every interval seconds a few warm-started bundle adjustment iterations
+    run on it. Poses that lower the window's reprojection error without
+    moving any camera too far are swapped into the cameras atomically.
+
+    """
+
+    def __init__(self, cameras, on_update=None, window_size=2000, min_observations=300, min_views=3, max_error=4.0, interval=10.0, max_nfev=10, max_rotation=2.0, max_translation=0.05, min_improvement=0.01):
+        self.cameras = cameras
+        self.on_update = on_update
+
+        self.min_observations = min_observations
+        self.min_views = min_views
+        self.max_error = max_error # mean squared pixels
+        self.interval = interval # seconds
+        self.max_nfev = max_nfev
+        # per refinement limits, larger moves are treated as a bad solve rather than drift
+        self.max_rotation = max_rotation # degrees
+        self.max_translation = max_translation # fraction of the distance to camera 0
+        self.min_improvement = min_improvement # fraction of the window error, smaller gains are not worth a swap
+
+        self.observations = collections.deque(maxlen=window_size)
+        self.observations_lock = threading.Lock()
+
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.num_updates = 0
+
+    def add_observations(self, image_point_groups, errors):
+        # called by the tracking loop every frame, only keeps the groups worth refining on
+        for image_point_group, error in zip(image_point_groups, errors):
+            num_views = sum(point[0] is not None for point in image_point_group)
+            if num_views >= self.min_views and error < self.max_error:
+                with self.observations_lock:
+                    self.observations.append(image_point_group)
+
+    def start(self):
+        if self.thread is not None:
+            return
+
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name="calibration-refiner", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.refine()
+            except Exception:
+                traceback.print_exc()
+
+    def refine(self):
+        calibration = self.cameras.calibration
+        with self.observations_lock:
+            observations = list(self.observations)
+        if calibration is None or len(observations) < self.min_observations:
+            return None
+
+        image_points = image_points_to_array(observations)
+        intrinsic_matrices = calibration.intrinsic_matrices
+        start_time = time.time()
+
+        # bundle_adjustment keeps camera 0 at the origin, solve in its frame
+        R0, t0 = calibration.camera_poses[0]["R"], calibration.camera_poses[0]["t"]
+        camera_poses = [{"R": camera_pose["R"] @ R0.T, "t": camera_pose["t"] - camera_pose["R"] @ R0.T @ t0} for camera_pose in calibration.camera_poses]
+
+        refined_poses = bundle_adjustment(image_points, camera_poses, None, intrinsic_matrices, optimize_points=True, max_nfev=self.max_nfev, verbose=0)
+
+        # the window does not constrain scale, keep the camera baselines the length they were
+        scale = sum(np.linalg.norm(camera_pose["t"]) for camera_pose in camera_poses[1:]) / max(sum(np.linalg.norm(camera_pose["t"]) for camera_pose in refined_poses[1:]), 1e-12)
+
+        new_poses = []
+        for camera_pose, refined_pose in zip(camera_poses, refined_poses):
+            rotation_change = np.degrees(Rotation.from_matrix(refined_pose["R"] @ camera_pose["R"].T).magnitude())
+            translation_change = np.linalg.norm(np.array(refined_pose["t"]) * scale - camera_pose["t"]) / max(np.linalg.norm(camera_pose["t"]), 1e-12)
+            if rotation_change > self.max_rotation or (np.linalg.norm(camera_pose["t"]) > 0 and translation_change > self.max_translation):
+                return None
+
+            R = refined_pose["R"] @ R0
+            new_poses.append({"R": R, "t": np.array(refined_pose["t"]) * scale + R @ R0.T @ t0})
+
+        error_before = self._window_error(image_points, calibration.camera_poses, intrinsic_matrices)
+        error_after = self._window_error(image_points, new_poses, intrinsic_matrices)
+        if not error_after < error_before * (1 - self.min_improvement):
+            return None
+
+        if not self.cameras.refine_camera_poses(calibration, [{"R": camera_pose["R"].tolist(), "t": camera_pose["t"].tolist()} for camera_pose in new_poses]):
+            return None
+
+        self.num_updates += 1
+        report = {
+            "updates": self.num_updates,
+            "observations": len(observations),
+            "errorBefore": float(error_before),
+            "errorAfter": float(error_after),
+            "solveTime": round(time.time() - start_time, 3)
+        }
+        if self.on_update is not None:
+            self.on_update(self.cameras.camera_poses, report)
+
+        return report
+
+    def _window_error(self, image_points, camera_poses, intrinsic_matrices):
+        Ps = get_projection_matrices(camera_poses, intrinsic_matrices)
+        return np.nanmean(reprojection_errors_batch(image_points, triangulate_points_batch(image_points, Ps), Ps))
@@ -0,0 +1,102 @@
+import numpy as np
+
+
+class EpipolarIndex:
+    """
+    Finds the points of one camera within a pixel tolerance of epipolar lines
+    coming from another camera without testing every point.
+
+    Every epipolar line passes through the epipole, so points are sorted by
+    their angle around it. A point at distance r from the epipole can only be
+    within the tolerance of lines whose angle differs by asin(tolerance / r),
+    so points are split into bands of doubling radius, each with its own
+    angular search window. Points close to the epipole are always tested.
+    When the epipole is at infinity the lines are parallel and points are
+    sorted by their offset along the common line normal instead.
+
+    """
+
+    def __init__(self, points, epipole, tolerance, near_radius=None):
+        self.points = np.array(points, dtype=np.float64).reshape((-1, 2))
+        self.tolerance = tolerance
+        epipole = np.array(epipole, dtype=np.float64)
+
+        self.is_epipole_at_infinity = abs(epipole[2]) < 1e-9 * np.linalg.norm(epipole[:2])
+        if self.is_epipole_at_infinity:
+            direction = epipole[:2] / np.linalg.norm(epipole[:2])
+            self.normal = np.array([-direction[1], direction[0]])
+            offsets = self.points @ self.normal
+            self.order = np.argsort(offsets)
+            self.offsets = offsets[self.order]
+            return
+
+        self.epipole = epipole[:2] / epipole[2]
+        near_radius = 4*tolerance if near_radius is None else near_radius
+
+        deltas = self.points - self.epipole
+        radii = np.hypot(deltas[:, 0], deltas[:, 1])
+        angles = np.mod(np.arctan2(deltas[:, 1], deltas[:, 0]), np.pi)
+
+        self.near_indices = np.nonzero(radii < near_radius)[0]
+
+        # (half window, sorted angles, point indices) per radial band. The angles are repeated shifted by -pi and +pi
+        # so every search window is one contiguous slice
+        self.bands = []
+        band_radius = near_radius
+        far_indices = np.nonzero(radii >= near_radius)[0]
+        while len(far_indices) != 0:
+            in_band = radii[far_indices] < 2*band_radius
+            band_indices = far_indices[in_band]
+            far_indices = far_indices[~in_band]
+            if len(band_indices) != 0:
+                order = np.argsort(angles[band_indices])
+                band_angles = angles[band_indices][order]
+                self.bands.append((
+                    min(np.arcsin(min(1, tolerance / band_radius)), np.pi/2),
+                    np.concatenate([band_angles - np.pi, band_angles, band_angles + np.pi]),
+                    np.tile(band_indices[order], 3)
+                ))
+            band_radius *= 2
+
+    def query(self, line):
+        # indices of the points within the tolerance of the line a*x + b*y + c = 0, with a^2 + b^2 = 1, and their distances
+        _, point_indices, distances = self.query_lines(np.array([line]))
+
+        return point_indices, distances
+
+    def query_lines(self, lines):
+        # every (line index, point index, distance) within the tolerance for an (N, 3) array of normalized lines
+        lines = np.array(lines, dtype=np.float64).reshape((-1, 3))
+
+        if self.is_epipole_at_infinity:
+            signs = np.where(lines[:, :2] @ self.normal >= 0, 1, -1)
+            starts = np.searchsorted(self.offsets, -lines[:, 2]*signs - self.tolerance)
+            ends = np.searchsorted(self.offsets, -lines[:, 2]*signs + self.tolerance)
+            line_indices, positions = _expand_ranges(starts, ends)
+            point_indices = self.order[positions]
+        else:
+            line_angles = np.mod(np.arctan2(lines[:, 0], -lines[:, 1]), np.pi)
+            line_indices = [np.repeat(np.arange(0, len(lines)), len(self.near_indices))]
+            point_indices = [np.tile(self.near_indices, len(lines))]
+            for half_window, band_angles, band_indices in self.bands:
+                starts = np.searchsorted(band_angles, line_angles - half_window)
+                ends = np.searchsorted(band_angles, line_angles + half_window)
+                band_line_indices, positions = _expand_ranges(starts, ends)
+                line_indices.append(band_line_indices)
+                point_indices.append(band_indices[positions])
+            line_indices = np.concatenate(line_indices)
+            point_indices = np.concatenate(point_indices)
+
+        distances = np.abs(np.sum(self.points[point_indices] * lines[line_indices, :2], axis=1) + lines[line_indices, 2])
+        within_tolerance = distances < self.tolerance
+
+        return line_indices[within_tolerance], point_indices[within_tolerance], distances[within_tolerance]
+
+
+def _expand_ranges(starts, ends):
+    # the (range index, position) of every position in the ranges [starts[i], ends[i])
+    lengths = np.maximum(ends - starts, 0)
+    range_indices = np.repeat(np.arange(0, len(starts)), lengths)
+    positions = np.arange(0, np.sum(lengths)) - np.repeat(np.cumsum(lengths) - lengths, lengths) + np.repeat(starts, lengths)
+
+    return range_indices, positions
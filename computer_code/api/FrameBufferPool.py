@@ -0,0 +1,50 @@
+import numpy as np
+
+
+class FrameBufferPool:
+    """
+    Preallocated images for every stage of Cameras._process_frame so steady
+    state frames don't allocate. Each camera has its own stage buffers, which
+    is safe because a camera is only ever processed by one worker per frame.
+    The processed previews are written straight into column slices of a
+    mosaic, a small ring of mosaics lets consumers read the last published
+    one while the next frame is written.
+
+    """
+
+    def __init__(self, num_cameras, size, channels, num_mosaics=3):
+        self.num_cameras = num_cameras
+        self.size = size
+        self.channels = channels
+        self.num_mosaics = num_mosaics
+
+        frame_shape = (size, size, channels) if channels > 1 else (size, size)
+        self.stages = [{
+            "remap": np.empty(frame_shape, dtype=np.uint8),
+            "blur": np.empty(frame_shape, dtype=np.uint8),
+            "sharpen": np.empty(frame_shape, dtype=np.uint8),
+            "grey": np.empty((size, size), dtype=np.uint8),
+            "binary": np.empty((size, size), dtype=np.uint8),
+            "labels": np.empty((size, size), dtype=np.int32)
+        } for _ in range(num_cameras)]
+
+        # mosaics are keyed by channel count, mono previews without overlays stay single channel
+        self.mosaics = {}
+        self.mosaic_index = 0
+        self._allocate_mosaics(3)
+        self._allocate_mosaics(channels)
+
+    def _allocate_mosaics(self, channels):
+        if channels in self.mosaics:
+            return
+
+        mosaic_shape = (self.size, self.size * self.num_cameras, channels) if channels > 1 else (self.size, self.size * self.num_cameras)
+        self.mosaics[channels] = [np.zeros(mosaic_shape, dtype=np.uint8) for _ in range(self.num_mosaics)]
+
+    def next_mosaic(self, channels):
+        # returns the next mosaic in the ring and a view of it for every camera
+        self._allocate_mosaics(channels)
+        self.mosaic_index = (self.mosaic_index + 1) % self.num_mosaics
+        mosaic = self.mosaics[channels][self.mosaic_index]
+
+        return mosaic, [mosaic[:, i*self.size:(i+1)*self.size] for i in range(self.num_cameras)]
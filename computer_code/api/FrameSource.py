@@ -0,0 +1,262 @@
+import glob
+import os
+import re
+import time
+import numpy as np
+import cv2 as cv
+
+
+class FrameSource:
+    """
+    Where Cameras gets its frames from. read() returns (frames, timestamps) in
+    the same layout as pseyepy's Camera.read(): one frame per camera, RGB when
+    colour is True and single channel greyscale otherwise.
+
+    """
+
+    num_cameras = 0
+    fps = 60
+    frame_shape = (480, 640)
+    colour = True
+
+    def read(self):
+        raise NotImplementedError
+
+    def read_rate(self):
+        # frames per second read() delivers them at, None when as fast as they can be produced
+        return self.fps
+
+    def edit_settings(self, exposure, gain):
+        pass
+
+    def end(self):
+        pass
+
+
+class PSEyeFrameSource(FrameSource):
+    def __init__(self, fps=60, gain=10, exposure=100, colour=True):
+        # only import pseyepy when live cameras are used so the pipeline also runs without the driver
+        from pseyepy import Camera
+
+        # colour=False has the camera send mono frames, a third of the USB bandwidth
+        self.cameras = Camera(fps=fps, resolution=Camera.RES_LARGE, gain=gain, exposure=exposure, colour=colour)
+        self.num_cameras = len(self.cameras.exposure)
+        self.fps = fps
+        self.frame_shape = (480, 640)
+        self.colour = colour
+
+    def read(self):
+        return self.cameras.read()
+
+    def edit_settings(self, exposure, gain):
+        self.cameras.exposure = [exposure] * self.num_cameras
+        self.cameras.gain = [gain] * self.num_cameras
+
+    def end(self):
+        self.cameras.end()
+
+
+class VideoFileFrameSource(FrameSource):
+    def __init__(self, file_names, fps=None, speed=1.0, loop=True, colour=True):
+        # speed scales playback relative to the recording, None or 0 replays as fast as frames are read
+        self.captures = []
+        for file_name in file_names:
+            capture = cv.VideoCapture(file_name)
+            if not capture.isOpened():
+                raise IOError(f"Could not open recording {file_name}")
+            self.captures.append(capture)
+
+        self.num_cameras = len(self.captures)
+        self.fps = fps or self.captures[0].get(cv.CAP_PROP_FPS) or 60
+        self.frame_shape = (
+            int(self.captures[0].get(cv.CAP_PROP_FRAME_HEIGHT)),
+            int(self.captures[0].get(cv.CAP_PROP_FRAME_WIDTH))
+        )
+        self.speed = speed
+        self.loop = loop
+        self.colour = colour
+
+        self.start_time = None
+        self.frame_index = 0
+
+    @staticmethod
+    def from_recording(file_name, **kwargs):
+        # pseyepy's Stream writes one file per camera as <name>_<camera>.avi
+        root, ext = os.path.splitext(file_name)
+        file_names = glob.glob(f"{root}_*{ext}")
+        file_names = [x for x in file_names if re.fullmatch(r"\d+", x[len(root)+1:-len(ext) or None])]
+        file_names.sort(key=lambda x: int(x[len(root)+1:-len(ext) or None]))
+        if len(file_names) == 0:
+            file_names = [file_name]
+
+        return VideoFileFrameSource(file_names, **kwargs)
+
+    def read_rate(self):
+        return self.fps * self.speed if self.speed else None
+
+    def read(self):
+        if self.start_time is None:
+            self.start_time = time.time()
+
+        timestamp = self.start_time + self.frame_index / self.fps
+        if self.speed:
+            time_until_frame = self.start_time + self.frame_index / (self.fps * self.speed) - time.time()
+            if time_until_frame > 0:
+                time.sleep(time_until_frame)
+
+        frames = []
+        for capture in self.captures:
+            ret, frame = capture.read()
+            if not ret and self.loop:
+                capture.set(cv.CAP_PROP_POS_FRAMES, 0)
+                ret, frame = capture.read()
+            if not ret:
+                raise EOFError("Reached the end of the recording")
+            frames.append(cv.cvtColor(frame, cv.COLOR_BGR2RGB if self.colour else cv.COLOR_BGR2GRAY))
+
+        self.frame_index += 1
+
+        return frames, [timestamp] * self.num_cameras
+
+    def end(self):
+        for capture in self.captures:
+            capture.release()
+
+
+class SyntheticFrameSource(FrameSource):
+    def __init__(self, camera_params, camera_poses, markers, fps=60, frame_shape=(480, 640), marker_radius=3, realtime=True, colour=True):
+        # markers is an (N, 3) array or a function of time in seconds returning one, in the same frame as camera_poses
+        self.camera_params = camera_params
+        self.camera_poses = [{
+            "R": np.array(camera_pose["R"], dtype=np.float64),
+            "t": np.array(camera_pose["t"], dtype=np.float64).flatten()
+        } for camera_pose in camera_poses]
+        self.markers = markers
+        self.num_cameras = len(camera_poses)
+        self.fps = fps
+        self.frame_shape = frame_shape
+        self.marker_radius = marker_radius
+        self.realtime = realtime
+        self.colour = colour
+
+        self.start_time = None
+        self.frame_index = 0
+
+    def read(self):
+        if self.start_time is None:
+            self.start_time = time.time()
+
+        timestamp = self.start_time + self.frame_index / self.fps
+        if self.realtime and timestamp > time.time():
+            time.sleep(timestamp - time.time())
+
+        markers = self.markers(self.frame_index / self.fps) if callable(self.markers) else self.markers
+        markers = np.array(markers, dtype=np.float64).reshape((-1, 3))
+
+        frames = [self._render(i, markers) for i in range(0, self.num_cameras)]
+        self.frame_index += 1
+
+        return frames, [timestamp] * self.num_cameras
+
+    def read_rate(self):
+        return self.fps if self.realtime else None
+
+    def _render(self, camera_num, markers):
+        height, width = self.frame_shape
+        frame = np.zeros((height, width, 3) if self.colour else (height, width), dtype=np.uint8)
+
+        camera_params = self.camera_params[camera_num]
+        camera_pose = self.camera_poses[camera_num]
+        in_front = (markers @ camera_pose["R"].T + camera_pose["t"])[:, 2] > 0
+        if not np.any(in_front):
+            return frame
+
+        # project into the padded square image the pipeline undistorts, then undo the padding and rotation
+        image_points, _ = cv.projectPoints(
+            markers[in_front],
+            cv.Rodrigues(camera_pose["R"])[0],
+            camera_pose["t"],
+            np.array(camera_params["intrinsic_matrix"], dtype=np.float64),
+            np.array(camera_params["distortion_coef"], dtype=np.float64)
+        )
+        image_points = image_points[:, 0, :]
+
+        rotation = camera_params["rotation"] % 4
+        rotated_height, rotated_width = (width, height) if rotation % 2 else (height, width)
+        size = max(rotated_height, rotated_width)
+        rotated_x = image_points[:, 0] - (size - rotated_width)//2
+        rotated_y = image_points[:, 1] - (size - rotated_height)//2
+        if rotation == 0:
+            x, y = rotated_x, rotated_y
+        elif rotation == 1:
+            x, y = width - 1 - rotated_y, rotated_x
+        elif rotation == 2:
+            x, y = width - 1 - rotated_x, height - 1 - rotated_y
+        else:
+            x, y = rotated_y, height - 1 - rotated_x
+
+        # draw with 4 bits of sub-pixel precision so the blob centres are not snapped to the pixel grid
+        for center_x, center_y in zip(x, y):
+            if not (-self.marker_radius <= center_x < width + self.marker_radius and -self.marker_radius <= center_y < height + self.marker_radius):
+                continue
+            center = (int(round(center_x * 16)), int(round(center_y * 16)))
+            cv.circle(frame, center, self.marker_radius * 16, (255, 255, 255) if self.colour else 255, -1, cv.LINE_AA, shift=4)
+
+        return frame
+
+
+def look_at_camera_pose(position, target, up=(0, 0, 1)):
+    position = np.array(position, dtype=np.float64)
+    z = np.array(target, dtype=np.float64) - position
+    z /= np.linalg.norm(z)
+    y = z * np.dot(up, z) - np.array(up, dtype=np.float64)
+    y /= np.linalg.norm(y)
+    x = np.cross(y, z)
+    R = np.array([x, y, z])
+
+    return {"R": R, "t": -R @ position}
+
+
+def ring_camera_poses(num_cameras, radius=2.5, height=2.0):
+    camera_poses = []
+    for i in range(0, num_cameras):
+        angle = 2*np.pi * i / num_cameras
+        camera_poses.append(look_at_camera_pose([radius*np.cos(angle), radius*np.sin(angle), height], [0, 0, 0]))
+
+    return camera_poses
+
+
+def circling_drone_markers(t, num_drones=2, radius=0.5, height=1.0):
+    # the three LED layout of marker-templates.json, 0.15 between the pair and 0.095 to the third LED.
+    # Odd drones have the third LED on the other side, which is how the templates tell them apart. y is
+    # mirrored on the way to world coordinates, so in a z up world drone i matches the template with drone_index i
+    body_markers = np.array([[-0.075, 0, 0], [0.075, 0, 0], [0, -0.0583, 0]])
+    markers = []
+    for i in range(0, num_drones):
+        angle = 0.5*t + 2*np.pi * i / num_drones
+        markers.append(body_markers * [1, -1 if i % 2 else 1, 1] + [radius*np.cos(angle), radius*np.sin(angle), height])
+
+    return np.concatenate(markers)
+
+
+def frame_source_from_env(camera_params, fps=60):
+    """
+    MOCAP_FRAME_SOURCE selects where frames come from:
+        pseyepy (default)       live PS3 Eye cameras
+        replay:<file.avi>       recordings from camera_save_video.py, MOCAP_REPLAY_SPEED=0 replays as fast as possible
+        synthetic               rendered markers circling in front of a ring of cameras, one per camera-params.json entry
+    MOCAP_MONO=1 captures and processes single channel frames.
+
+    """
+    frame_source = os.environ.get("MOCAP_FRAME_SOURCE", "pseyepy")
+    colour = os.environ.get("MOCAP_MONO", "0") != "1"
+
+    if frame_source == "pseyepy":
+        return PSEyeFrameSource(fps=fps, colour=colour)
+    elif frame_source.startswith("replay:"):
+        speed = float(os.environ.get("MOCAP_REPLAY_SPEED", 1.0))
+        return VideoFileFrameSource.from_recording(frame_source[len("replay:"):], speed=speed, colour=colour)
+    elif frame_source == "synthetic":
+        return SyntheticFrameSource(camera_params, ring_camera_poses(len(camera_params)), circling_drone_markers, fps=fps, colour=colour)
+
+    raise ValueError(f"Unknown frame source {frame_source}")
@@ -0,0 +1,78 @@
+import time
+import numpy as np
+
+
+class LatencyTracer:
+    """
+    Per frame durations of every pipeline stage, from the camera capture to
+    the last serial write. The tracking thread is the only writer: it fills
+    the current frame's row and then publishes it into a ring buffer by
+    advancing the frame count, so recording never takes a lock. Readers
+    copy the buffer and skip the row that may be half overwritten.
+
+    """
+
+    STAGES = ["capture", "preprocess", "detect", "correspondence", "triangulate", "locate", "filter", "serialize", "write", "total"]
+    HISTOGRAM_BINS = [0, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, np.inf] # milliseconds
+
+    def __init__(self, capacity=1024):
+        self.is_enabled = True
+        self.stage_indices = {stage: i for i, stage in enumerate(self.STAGES)}
+        self.durations = np.full((capacity, len(self.STAGES)), np.nan)
+        # plain floats, numpy scalars would cost more than the spans they time
+        self.frame_durations = [np.nan] * len(self.STAGES)
+        self.num_frames = 0
+
+    def start_frame(self):
+        self.frame_durations = [np.nan] * len(self.STAGES)
+
+    def record(self, stage, duration):
+        # seconds spent in stage for the current frame, repeated stages add up
+        if not self.is_enabled:
+            return
+        i = self.stage_indices[stage]
+        previous_duration = self.frame_durations[i]
+        self.frame_durations[i] = duration if previous_duration != previous_duration else previous_duration + duration
+
+    def record_since(self, stage, start_time):
+        # records the time since start_time from time.perf_counter() and returns the current time, for chaining stages
+        time_now = time.perf_counter()
+        self.record(stage, time_now - start_time)
+
+        return time_now
+
+    def end_frame(self):
+        # publishes the current frame
+        if not self.is_enabled:
+            return
+
+        self.durations[self.num_frames % len(self.durations)] = self.frame_durations
+        self.num_frames += 1
+
+    def summary(self):
+        # p50/p95/p99 and a histogram in milliseconds per stage over the frames in the buffer
+        num_frames = self.num_frames
+        durations = self.durations.copy()
+        num_rows = min(num_frames, len(durations) - 1)
+        rows = (num_frames - 1 - np.arange(0, num_rows)) % len(durations)
+        durations = 1000 * durations[rows]
+
+        stages = {}
+        for stage, i in self.stage_indices.items():
+            stage_durations = durations[:, i][~np.isnan(durations[:, i])]
+            if len(stage_durations) == 0:
+                continue
+            p50, p95, p99 = np.percentile(stage_durations, [50, 95, 99])
+            stages[stage] = {
+                "frames": len(stage_durations),
+                "p50": round(float(p50), 3),
+                "p95": round(float(p95), 3),
+                "p99": round(float(p99), 3),
+                "histogram": np.histogram(stage_durations, self.HISTOGRAM_BINS)[0].tolist()
+            }
+
+        return {
+            "frames": num_rows,
+            "histogramBins": [bin if np.isfinite(bin) else None for bin in self.HISTOGRAM_BINS],
+            "stages": stages
+        }
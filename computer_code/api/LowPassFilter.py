@@ -1,23 +1,49 @@
 import numpy as np
-from scipy.signal import butter, lfilter
+from scipy.signal import butter
 
 class LowPassFilter:
 
-    def __init__(self, cutoff_frequency, sampling_frequency, dims, order=5, buffer_size=300):
+    def __init__(self, cutoff_frequency, sampling_frequency, dims, order=5):
         self.sampling_frequency = sampling_frequency
         self.cutoff_frequency = cutoff_frequency
         self.order = order
+        # dims is the number of channels or the shape of every sample, e.g. (num_drones, 3) filters many drones at once
+        self.shape = (dims,) if np.isscalar(dims) else tuple(dims)
         self.dims = dims
-        self.buffer_size = buffer_size
-        self.buffered_data = np.empty((0, dims))
         self.b, self.a = butter(self.order, self.cutoff_frequency / (self.sampling_frequency / 2), btype='low')
 
-    def filter(self, data):
-        self.buffered_data = np.vstack((self.buffered_data, data[np.newaxis]))
+        # direct form II transposed state, one delay line of length order per channel, updated in place every sample
+        self.b_column = self.b[1:].reshape((-1,) + (1,)*len(self.shape))
+        self.a_column = self.a[1:].reshape((-1,) + (1,)*len(self.shape))
+        self.z = np.zeros((self.order,) + self.shape)
+        self.z_update = np.zeros_like(self.z)
+        self.last_output = np.zeros(self.shape)
 
-        filtered_data = np.apply_along_axis(lambda x: lfilter(self.b, self.a, x), axis=0, arr=self.buffered_data)
-    
-        if self.buffered_data.shape[0] >= self.buffer_size:
-            self.buffered_data = self.buffered_data[-self.buffer_size//2:]  # Keep the last half of the buffered data for the next filtering iteration
+    def filter(self, data, mask=None):
+        # one sample per channel in O(order), channels where mask is False keep their state and last output
+        x = np.asarray(data, dtype=np.float64).reshape(self.shape)
+        if mask is not None:
+            mask = np.broadcast_to(mask, self.shape)
+            skipped_state = self.z[:, ~mask]
 
-        return filtered_data[-1]
\ No newline at end of file
+        y = self.b[0] * x + self.z[0]
+        self.z[:-1] = self.z[1:]
+        self.z[-1] = 0
+        np.multiply(self.b_column, x, out=self.z_update)
+        self.z_update -= self.a_column * y
+        self.z += self.z_update
+
+        if mask is None:
+            self.last_output[...] = y
+        else:
+            self.z[:, ~mask] = skipped_state
+            self.last_output[mask] = y[mask]
+
+        return self.last_output.copy()
+
+    def reset(self, mask=None):
+        if mask is None:
+            mask = np.ones(self.shape, dtype=bool)
+        mask = np.broadcast_to(mask, self.shape)
+        self.z[:, mask] = 0
+        self.last_output[mask] = 0
@@ -0,0 +1,96 @@
+import threading
+import time
+import traceback
+import cv2 as cv
+
+
+class PreviewSubscriber:
+    def __init__(self, max_fps=None, scale=1.0, quality=95):
+        self.min_interval = 1.0 / max_fps if max_fps else 0
+        self.scale = scale
+        self.quality = int(quality)
+        self.last_sent_time = 0
+
+        # a single slot, a slow client only ever gets the newest frame and never holds up the others
+        self.jpeg_condition = threading.Condition()
+        self.jpeg_id = 0
+        self.jpeg = None
+
+    def encoding(self):
+        return (self.scale, self.quality)
+
+    def put(self, jpeg):
+        with self.jpeg_condition:
+            self.jpeg_id += 1
+            self.jpeg = jpeg
+            self.jpeg_condition.notify_all()
+
+    def wait_for_jpeg(self, last_jpeg_id, timeout=1.0):
+        with self.jpeg_condition:
+            self.jpeg_condition.wait_for(lambda: self.jpeg_id != last_jpeg_id, timeout=timeout)
+            return self.jpeg_id, self.jpeg
+
+
+class MjpegBroadcaster:
+    """
+    Encodes each preview frame from the TrackingLoop once per distinct
+    (scale, quality) and fans the JPEG bytes out to every /api/camera-stream
+    client. Encoding runs on its own thread so it never delays tracking.
+
+    """
+
+    def __init__(self, tracking_loop):
+        self.tracking_loop = tracking_loop
+
+        self.subscribers = []
+        self.subscribers_lock = threading.Lock()
+
+        self.thread = threading.Thread(target=self._run, name="mjpeg-broadcaster", daemon=True)
+        self.thread.start()
+
+    def subscribe(self, max_fps=None, scale=1.0, quality=95):
+        subscriber = PreviewSubscriber(max_fps, scale, quality)
+        with self.subscribers_lock:
+            self.subscribers.append(subscriber)
+        self.tracking_loop.add_preview_subscriber()
+
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.subscribers_lock:
+            self.subscribers.remove(subscriber)
+        self.tracking_loop.remove_preview_subscriber()
+
+    def _run(self):
+        frame_id = None
+
+        while True:
+            # encoding can take longer than a frame, work on a copy so the tracking loop never overwrites it midway
+            frame_id, frames = self.tracking_loop.wait_for_frame(frame_id, copy=True)
+            if frames is None:
+                continue
+
+            time_now = time.time()
+            with self.subscribers_lock:
+                due_subscribers = [x for x in self.subscribers if time_now - x.last_sent_time >= x.min_interval]
+
+            jpegs = {}
+            for subscriber in due_subscribers:
+                # one failing encoding only skips the subscribers that asked for it
+                encoding = subscriber.encoding()
+                if encoding not in jpegs:
+                    try:
+                        jpegs[encoding] = self._encode(frames, *encoding)
+                    except Exception:
+                        traceback.print_exc()
+                        jpegs[encoding] = None
+                if jpegs[encoding] is None:
+                    continue
+                subscriber.last_sent_time = time_now
+                subscriber.put(jpegs[encoding])
+
+    def _encode(self, frames, scale, quality):
+        if scale != 1.0:
+            frames = cv.resize(frames, None, fx=scale, fy=scale, interpolation=cv.INTER_AREA)
+
+        return cv.imencode('.jpg', frames, [cv.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
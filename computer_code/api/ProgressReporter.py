@@ -0,0 +1,52 @@
+import threading
+
+
+class ProgressReporter:
+    """
+    Passes the latest progress of a long running computation to a callback
+    at a fixed wall clock rate from its own thread. The computation only
+    stores its progress, however often it calls update.
+
+    """
+
+    def __init__(self, callback, interval=0.5):
+        self.callback = callback
+        self.interval = interval
+
+        self.progress = None
+        self.is_updated = False
+        self.lock = threading.Lock()
+
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def update(self, progress):
+        with self.lock:
+            self.progress = progress
+            self.is_updated = True
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name="progress-reporter", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        # the last update is always reported
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self._report()
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self._report()
+
+    def _report(self):
+        with self.lock:
+            if not self.is_updated:
+                return
+            progress = self.progress
+            self.is_updated = False
+
+        self.callback(progress)
@@ -0,0 +1,186 @@
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from KalmanFilter import KalmanFilter
+from LowPassFilter import LowPassFilter
+import time
+
+class Tracker:
+    """
+    Keeps drone tracks alive across frames. Every frame all tracks are
+    predicted with one Kalman filter bank and matched to the located objects
+    by a single global assignment on the Mahalanobis distance between the
+    predicted and located positions, gated so that far or differently
+    identified objects are never matched. The gate uses the predicted
+    position covariance plus the triangulation noise, not the much looser
+    measurement noise the filters are tuned with, and is capped at
+    max_distance meters. The identity of a track is the
+    drone index of the marker template that created it.
+
+    An unmatched object of an untracked drone starts a tentative track that
+    is confirmed after confirm_hits matches in a row. A confirmed track that
+    is not matched coasts on its prediction and is retired once it has not
+    been seen for max_coast_time seconds.
+
+    Tracks are timed by the capture time of the frames, not by when the
+    frames are processed, and can be extrapolated to when their position is
+    actually sent.
+
+    """
+
+    def __init__(self, num_objects, gate=11.34, position_noise=4e-4, max_distance=0.5, confirm_hits=3, max_coast_time=0.5, max_extrapolation_time=0.05):
+        self.num_objects = num_objects
+        self.gate = gate # squared Mahalanobis distance, 99% of a 3 dof chi-squared
+        self.position_noise_cov = np.eye(3) * position_noise # triangulated position variance in m^2, about 2 cm standard deviation
+        self.max_distance = max_distance # meters, the filters settle at a position variance that alone would allow about 1 m, and lag a fast new track by up to 0.3 m
+        self.confirm_hits = confirm_hits
+        self.max_coast_time = max_coast_time # seconds
+        self.max_extrapolation_time = max_extrapolation_time # seconds past the last capture time
+
+        self.kalman_filter = KalmanFilter(num_objects)
+        self.velocity_low_pass_filter = LowPassFilter(cutoff_frequency=20, sampling_frequency=60.0, dims=(num_objects, 3))
+        self.heading_low_pass_filter = LowPassFilter(cutoff_frequency=20, sampling_frequency=60.0, dims=num_objects)
+
+        # one slot per track, a slot is free when it is not active
+        self.is_active = np.zeros(num_objects, dtype=bool)
+        self.is_confirmed = np.zeros(num_objects, dtype=bool)
+        self.is_coasting = np.zeros(num_objects, dtype=bool)
+        self.drone_indices = np.full(num_objects, -1)
+        self.track_ids = np.full(num_objects, -1)
+        self.hits = np.zeros(num_objects, dtype=int)
+        self.last_seen_times = np.zeros(num_objects)
+        self.prev_positions = np.zeros((num_objects, 3))
+
+        self.next_track_id = 0
+        self.prev_time = None
+
+    def update(self, objects, time_now=None):
+        # match the located objects of the frame captured at time_now to the tracks, returns the confirmed tracks ordered by drone index
+        time_now = time.time() if time_now is None else time_now
+        dt = 0 if self.prev_time is None else time_now - self.prev_time
+        self.prev_time = time_now
+
+        objects = [object for object in objects if 0 <= object["droneIndex"] < self.num_objects]
+        positions = np.array([object["pos"] for object in objects], dtype=np.float64).reshape((-1, 3))
+        object_drone_indices = np.array([object["droneIndex"] for object in objects], dtype=int)
+
+        tracks = np.nonzero(self.is_active)[0]
+        transition_matrix, process_noise_cov = self.kalman_filter.transition(dt)
+        predicted_states = self.kalman_filter.predict(tracks, transition_matrix, process_noise_cov)
+
+        track_matches, object_matches = self._assign(tracks, predicted_states, positions, object_drone_indices)
+        matched_tracks = tracks[track_matches]
+
+        if len(matched_tracks) != 0:
+            time_since_seen = np.maximum(time_now - self.last_seen_times[matched_tracks], 1e-6)
+            new_positions = positions[object_matches]
+            new_velocities = (new_positions - self.prev_positions[matched_tracks]) / time_since_seen[:, np.newaxis]
+            self.prev_positions[matched_tracks] = new_positions
+            self.kalman_filter.correct(matched_tracks, np.hstack((new_positions, new_velocities)))
+
+            self.hits[matched_tracks] += 1
+            self.last_seen_times[matched_tracks] = time_now
+            self.is_confirmed[matched_tracks] |= self.hits[matched_tracks] >= self.confirm_hits
+
+        is_matched = np.zeros(self.num_objects, dtype=bool)
+        is_matched[matched_tracks] = True
+        self.is_coasting = self.is_active & ~is_matched
+        self._retire(time_now)
+
+        headings = np.zeros(self.num_objects)
+        headings[matched_tracks] = [objects[i]["heading"] for i in object_matches]
+        headings = self.heading_low_pass_filter.filter(headings, is_matched)
+        velocities = self.velocity_low_pass_filter.filter(self.kalman_filter.states[:, 3:6], is_matched[:, np.newaxis])
+
+        unmatched_objects = np.setdiff1d(np.arange(0, len(objects)), object_matches)
+        self._start_tracks(positions[unmatched_objects], object_drone_indices[unmatched_objects], time_now)
+
+        res = []
+        for track in np.nonzero(self.is_active & self.is_confirmed)[0]:
+            res.append({
+                "pos": self.kalman_filter.states[track, :3].copy(),
+                "vel": velocities[track],
+                "heading": float(headings[track]),
+                "droneIndex": int(self.drone_indices[track]),
+                "trackId": int(self.track_ids[track]),
+                "isCoasting": bool(self.is_coasting[track]),
+                "timestamp": time_now
+            })
+        res.sort(key=lambda track: track["droneIndex"])
+
+        return res
+
+    def _assign(self, tracks, predicted_states, positions, object_drone_indices):
+        # (track positions, object indices) of the minimum total cost matching, only pairs inside the gate
+        if len(tracks) == 0 or len(positions) == 0:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+
+        # the filters' measurement noise of 1 m^2 would open the gate to meters, triangulation is good to centimeters
+        innovation_covariances = self.kalman_filter.covariances[tracks][:, :3, :3] + self.position_noise_cov
+        innovations = positions[np.newaxis, :, :] - predicted_states[:, np.newaxis, :3]
+        costs = np.einsum("tmi,tij,tmj->tm", innovations, np.linalg.inv(innovation_covariances), innovations)
+        distances = np.linalg.norm(innovations, axis=2)
+
+        is_allowed = (costs < self.gate) & (distances < self.max_distance) & (self.drone_indices[tracks][:, np.newaxis] == object_drone_indices[np.newaxis, :])
+        # pairs outside the gate get a cost no allowed matching can reach, and are dropped after the assignment
+        costs = np.where(is_allowed, costs, self.gate * (len(tracks) + len(positions) + 1))
+        track_matches, object_matches = linear_sum_assignment(costs)
+        is_match = is_allowed[track_matches, object_matches]
+
+        return track_matches[is_match], object_matches[is_match]
+
+    def _retire(self, time_now):
+        # tentative tracks die at their first miss, confirmed ones after coasting for max_coast_time
+        is_lost = self.is_coasting & (~self.is_confirmed | (time_now - self.last_seen_times > self.max_coast_time))
+        self.is_active[is_lost] = False
+        self.is_coasting[is_lost] = False
+
+    def _start_tracks(self, positions, drone_indices, time_now):
+        # a new track for every drone that has none, from its first unmatched object
+        drone_indices, first_objects = np.unique(drone_indices, return_index=True)
+        is_untracked = ~np.isin(drone_indices, self.drone_indices[self.is_active])
+        drone_indices, first_objects = drone_indices[is_untracked], first_objects[is_untracked]
+
+        free_tracks = np.nonzero(~self.is_active)[0][:len(drone_indices)]
+        drone_indices, first_objects = drone_indices[:len(free_tracks)], first_objects[:len(free_tracks)]
+        if len(free_tracks) == 0:
+            return
+
+        self.kalman_filter.initialize(free_tracks, positions[first_objects])
+        self.prev_positions[free_tracks] = positions[first_objects]
+        is_new = np.zeros(self.num_objects, dtype=bool)
+        is_new[free_tracks] = True
+        self.velocity_low_pass_filter.reset(is_new[:, np.newaxis])
+        self.heading_low_pass_filter.reset(is_new)
+
+        self.is_active[free_tracks] = True
+        self.is_confirmed[free_tracks] = self.confirm_hits <= 1
+        self.drone_indices[free_tracks] = drone_indices
+        self.track_ids[free_tracks] = np.arange(self.next_track_id, self.next_track_id + len(free_tracks))
+        self.next_track_id += len(free_tracks)
+        self.hits[free_tracks] = 1
+        self.last_seen_times[free_tracks] = time_now
+
+    def predict_positions(self, time_now):
+        # (drone index, position) of every confirmed track at time_now, without updating the filters
+        tracks = np.nonzero(self.is_active & self.is_confirmed)[0]
+
+        return list(zip(self.drone_indices[tracks].tolist(), self._extrapolate(tracks, time_now)))
+
+    def extrapolate(self, track_id, time_now):
+        # position of the track with track_id at time_now, e.g. the time it is sent to the drone
+        tracks = np.nonzero(self.is_active & (self.track_ids == track_id))[0]
+
+        return self._extrapolate(tracks, time_now)[0]
+
+    def _extrapolate(self, tracks, time_now):
+        # never further than max_extrapolation_time ahead, so a stalled frame or an odd clock cannot fling a drone
+        dt = 0 if self.prev_time is None else np.clip(time_now - self.prev_time, 0, self.max_extrapolation_time)
+        states = self.kalman_filter.states[tracks]
+
+        return states[:, 0:3] + states[:, 3:6]*dt + 0.5*states[:, 6:9]*dt**2
+
+    def reset(self):
+        self.is_active[...] = False
+        self.is_confirmed[...] = False
+        self.is_coasting[...] = False
+        self.prev_time = None
@@ -0,0 +1,109 @@
+import threading
+import time
+import traceback
+
+
+class TrackingLoop:
+    def __init__(self, cameras, socketio, fps=60):
+        self.cameras = cameras
+        self.socketio = socketio
+        # fps None runs as fast as frames arrive, e.g. a recording replayed with MOCAP_REPLAY_SPEED=0
+        self.loop_interval = 0 if fps is None else 1.0 / fps
+
+        self.thread = None
+        self.is_running = False
+
+        # latest results, consumers wait on frame_condition for a new frame_id
+        self.frame_condition = threading.Condition()
+        self.frame_id = 0
+        self.frames = None
+        self.frame_time = None
+
+        self.overruns = 0
+
+        # per stage latency percentiles are only worth computing about once a second
+        self.latency_interval = 1.0
+
+        # the cameras only render the preview and its overlays while somebody subscribes to it
+        self.preview_subscribers = 0
+        self.preview_subscribers_lock = threading.Lock()
+        self.cameras.is_preview_enabled = False
+
+    def start(self):
+        if self.is_running:
+            return
+
+        self.is_running = True
+        self.thread = threading.Thread(target=self._run, name="tracking-loop", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.is_running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def add_preview_subscriber(self):
+        with self.preview_subscribers_lock:
+            self.preview_subscribers += 1
+            self.cameras.is_preview_enabled = True
+
+    def remove_preview_subscriber(self):
+        with self.preview_subscribers_lock:
+            self.preview_subscribers -= 1
+            self.cameras.is_preview_enabled = self.preview_subscribers > 0
+
+    def wait_for_frame(self, last_frame_id, timeout=1.0, copy=False):
+        # the frames live in a small ring of mosaics the loop keeps writing into, a consumer that holds on to them
+        # for longer than a frame needs a copy. Copying under the lock is safe, the loop can't publish into the same
+        # mosaic again before it has published the next one
+        with self.frame_condition:
+            self.frame_condition.wait_for(lambda: self.frame_id != last_frame_id, timeout=timeout)
+            if copy and self.frames is not None:
+                return self.frame_id, self.frames.copy()
+            return self.frame_id, self.frames
+
+    def _publish(self, frames, frame_time):
+        with self.frame_condition:
+            self.frame_id += 1
+            self.frames = frames
+            self.frame_time = frame_time
+            self.frame_condition.notify_all()
+
+    def _run(self):
+        next_deadline = time.perf_counter()
+        fps_start_time = next_deadline
+        latency_time = next_deadline
+        i = 0
+
+        while self.is_running:
+            time_now = time.perf_counter()
+            if time_now < next_deadline:
+                time.sleep(next_deadline - time_now)
+
+            try:
+                frames = self.cameras.get_frames()
+                self._publish(frames, time.time())
+            except Exception:
+                traceback.print_exc()
+
+            # schedule against fixed deadlines, if we fell behind skip the missed slots instead of bursting
+            next_deadline += self.loop_interval
+            time_now = time.perf_counter()
+            if self.loop_interval == 0:
+                next_deadline = time_now
+            elif time_now > next_deadline:
+                missed_intervals = int((time_now - next_deadline) / self.loop_interval) + 1
+                self.overruns += missed_intervals
+                next_deadline += missed_intervals * self.loop_interval
+
+            i = (i+1)%10
+            if i == 0:
+                self.socketio.emit("fps", {"fps": round(10 / (time_now - fps_start_time)), "overruns": self.overruns})
+                correspondence_metrics = self.cameras.get_correspondence_metrics()
+                if correspondence_metrics is not None:
+                    self.socketio.emit("correspondence-metrics", correspondence_metrics)
+                if time_now - latency_time >= self.latency_interval:
+                    self.socketio.emit("latency", self.cameras.latency_tracer.summary())
+                    latency_time = time_now
+                fps_start_time = time_now
@@ -0,0 +1,50 @@
+import json
+import os
+import sys
+import threading
+import traceback
+
+# events for CalibrationJobRunner go to the original stdout as json lines, anything else printed while solving goes to stderr
+events = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+sys.stdout = sys.stderr
+
+# low priority and the cores CalibrationJobRunner picked, before the numeric libraries start their thread pools
+if hasattr(os, "nice"):
+    os.nice(int(os.environ.get("MOCAP_CALIBRATION_NICENESS", 0)))
+if hasattr(os, "sched_setaffinity") and os.environ.get("MOCAP_CALIBRATION_CPU_SET"):
+    os.sched_setaffinity(0, [int(cpu) for cpu in os.environ["MOCAP_CALIBRATION_CPU_SET"].split(",")])
+
+import cv2 as cv
+from helpers import calculate_camera_poses, camera_pose_to_serializable
+
+events_lock = threading.Lock()
+
+
+def send(event):
+    with events_lock:
+        events.write(json.dumps(event) + "\n")
+        events.flush()
+
+
+def main():
+    job = json.load(sys.stdin)
+    cv.setNumThreads(int(os.environ.get("MOCAP_CPU_BUDGET", 1)))
+
+    try:
+        camera_poses, report = calculate_camera_poses(
+            job["image_points"], 
+            job["intrinsic_matrices"], 
+            lambda camera_poses: send({"type": "progress", "camera_poses": camera_pose_to_serializable(camera_poses)}),
+            job["target_sample_count"],
+            job["image_sizes"]
+        )
+    except Exception as e:
+        traceback.print_exc()
+        send({"type": "failed", "message": str(e)})
+        return
+
+    send({"type": "done", "camera_poses": camera_pose_to_serializable(camera_poses), **report})
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,34 @@
 import numpy as np
-from scipy import linalg, optimize, signal
+from scipy import optimize, signal
 import cv2 as cv
 from scipy.spatial.transform import Rotation
-import copy
+from scipy.spatial import distance
+from scipy import sparse
 import json
 import os
 import time
+import threading
+import itertools
 import numpy as np
 import cv2 as cv
-from KalmanFilter import KalmanFilter
-from pseyepy import Camera
+from concurrent.futures import ThreadPoolExecutor
+from Tracker import Tracker
+from FrameBufferPool import FrameBufferPool
+from FrameSource import frame_source_from_env
 from Singleton import Singleton
+from ProgressReporter import ProgressReporter
+from Calibration import Calibration
+from EpipolarIndex import EpipolarIndex
+from LatencyTracer import LatencyTracer
+
+
+SHARPEN_KERNEL = np.array([[-2,-1,-1,-1,-2],
+                           [-1,1,3,1,-1],
+                           [-1,3,4,3,-1],
+                           [-1,1,3,1,-1],
+                           [-2,-1,-1,-1,-2]])
+
+EPIPOLAR_LINE_COLORS = [(255,0,0), (0,255,0), (0,0,255), (255,255,0), (255,0,255), (0,255,255), (255,128,0), (128,0,255)]
 
 
 @Singleton
@@ -21,10 +39,28 @@ class Cameras:
         f = open(filename)
         self.camera_params = json.load(f)
 
-        self.cameras = Camera(fps=60, resolution=Camera.RES_LARGE, gain=10, exposure=100)
-        self.num_cameras = len(self.cameras.exposure)
+        self.marker_templates = load_marker_templates(os.path.join(dirname, "marker-templates.json"))
+
+        # 60 is what live cameras are asked for, recordings play back at the rate they were made at
+        self.frame_source = frame_source_from_env(self.camera_params, fps=60)
+        self.fps = self.frame_source.fps
+        self.num_cameras = self.frame_source.num_cameras
         print(self.num_cameras)
 
+        # per camera numpy copies of camera_params and the remap that replaces rot90 + make_square + undistort
+        self.frame_shape = self.frame_source.frame_shape
+        self.colour = self.frame_source.colour
+        self.camera_params_arrays = [None] * len(self.camera_params)
+        self.camera_remaps = [None] * len(self.camera_params)
+        for i in range(0, len(self.camera_params)):
+            self._update_camera_params(i)
+        self.frame_buffers = None
+        self._allocate_frame_buffers()
+
+        # where the time goes between capture and the serial write, preprocess and detect seconds per camera
+        self.latency_tracer = LatencyTracer()
+        self.camera_stage_times = np.zeros((self.num_cameras, 2))
+
         self.is_capturing_points = False
 
         self.is_triangulating_points = False
@@ -32,22 +68,88 @@ class Cameras:
 
         self.is_locating_objects = False
 
-        self.to_world_coords_matrix = None
+        self._to_world_coords_matrix = None
+
+        # projection and fundamental matrices etc, rebuilt only when the poses, intrinsics or world transform change
+        self.calibration = None
+        self.calibration_lock = threading.RLock()
+
+        # optional CalibrationRefiner fed with the live correspondences
+        self.calibration_refiner = None
 
         self.drone_armed = []
 
         self.num_objects = None
 
-        self.kalman_filter = None
+        # drone tracks kept across frames, recreated whenever triangulation starts
+        self.tracker = None
 
         self.socketio = None
         self.ser = None
 
         self.serialLock = None
 
+        # blobs outside these pixel areas are noise and never reach correspondence matching
+        self.blob_min_area = 2
+        self.blob_max_area = None
+
+        # correspondence matching, hypotheses beyond max_hypotheses are dropped, the metrics are reset every time they are read
+        self.epipolar_tolerance = 5 # pixels
+        self.max_hypotheses = 256
+        self.correspondence_metrics_lock = threading.Lock()
+        self._reset_correspondence_metrics()
+
+        # once drones are tracked only search windows around their predicted positions, with a periodic full scan
+        self.is_roi_detection = False
+        self.roi_radius = 0.15 # meters around the predicted drone position
+        self.roi_margin = 10 # pixels
+        self.roi_full_scan_interval = 30 # frames
+        self.frames_since_full_scan = 0
+        self.roi_track_lost = True
+
+        # overlays are only drawn while a preview consumer is subscribed, headless never renders any image output
+        self.is_preview_enabled = True
+        self.headless = os.environ.get("MOCAP_HEADLESS", "0") == "1"
+
+        # one worker per camera runs the preprocess + detect chain, OpenCV releases the GIL
+        self.worker_pool = None
+        self.set_num_workers(self.num_cameras)
+
         global cameras_init
         cameras_init = True
 
+    @property
+    def to_world_coords_matrix(self):
+        return self._to_world_coords_matrix
+
+    @to_world_coords_matrix.setter
+    def to_world_coords_matrix(self, to_world_coords_matrix):
+        with self.calibration_lock:
+            self._to_world_coords_matrix = to_world_coords_matrix
+            self._update_calibration()
+
+    def _update_calibration(self):
+        with self.calibration_lock:
+            if self.camera_poses is None:
+                self.calibration = None
+                return
+
+            # build the new calibration fully before swapping it in, the tracking loop only ever sees a complete one
+            intrinsic_matrices = [camera_params["intrinsic_matrix"] for camera_params in self.camera_params_arrays]
+            self.calibration = Calibration(intrinsic_matrices, self.camera_poses, self._to_world_coords_matrix)
+
+    def refine_camera_poses(self, calibration, camera_poses):
+        # swap in refined poses unless the calibration they were solved from was replaced in the meantime
+        with self.calibration_lock:
+            if self.calibration is not calibration:
+                return False
+            self.camera_poses = camera_poses
+            self._update_calibration()
+            return True
+
+    def set_calibration_refiner(self, calibration_refiner):
+        self.calibration_refiner = calibration_refiner
+
     def set_socketio(self, socketio):
         self.socketio = socketio
     
@@ -62,64 +164,237 @@ class Cameras:
         self.drone_armed = [False for i in range(0, self.num_objects)]
     
     def edit_settings(self, exposure, gain):
-        self.cameras.exposure = [exposure] * self.num_cameras
-        self.cameras.gain = [gain] * self.num_cameras
+        self.frame_source.edit_settings(exposure, gain)
+
+    def set_frame_source(self, frame_source):
+        self.frame_source.end()
+        self.frame_source = frame_source
+        self.num_cameras = frame_source.num_cameras
+        self.fps = frame_source.fps
+        self.frame_shape = frame_source.frame_shape
+        self.colour = frame_source.colour
+        for i in range(0, len(self.camera_params)):
+            self._update_camera_params(i)
+        self._allocate_frame_buffers()
+        self.set_num_workers(self.num_cameras)
+
+    def _allocate_frame_buffers(self):
+        size = self.camera_remaps[0]["map1"].shape[0]
+        self.frame_buffers = FrameBufferPool(self.num_cameras, size, 3 if self.colour else 1)
+
+    def set_blob_area_limits(self, min_area, max_area):
+        self.blob_min_area = min_area
+        self.blob_max_area = max_area
+
+    def set_num_workers(self, num_workers):
+        # num_workers <= 1 processes the cameras sequentially on the calling thread
+        if self.worker_pool is not None:
+            self.worker_pool.shutdown(wait=True)
+            self.worker_pool = None
+
+        if num_workers > 1:
+            self.worker_pool = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="camera-worker")
+
+    def _process_frame(self, camera_num, frame, find_dots, rois=None, preview=None):
+        # every stage writes into the camera's preallocated buffers, the preview goes straight into the mosaic
+        start_time = time.perf_counter()
+        buffers = self.frame_buffers.stages[camera_num]
+        frame = apply_camera_remap(frame, self.camera_remaps[camera_num], dst=buffers["remap"])
+        frame = cv.GaussianBlur(frame, (9,9), 0, dst=buffers["blur"])
+        frame = cv.filter2D(frame, -1, SHARPEN_KERNEL, dst=buffers["sharpen"])
+
+        detect_start_time = time.perf_counter()
+        dots = None
+        if find_dots:
+            dots = self._find_dot(frame, rois, buffers)
+        self.camera_stage_times[camera_num] = (detect_start_time - start_time, time.perf_counter() - detect_start_time)
+
+        # the preview image is only produced when someone is watching, detection never depends on it
+        if preview is not None:
+            if self.colour:
+                cv.cvtColor(frame, cv.COLOR_RGB2BGR, dst=preview)
+            elif find_dots:
+                cv.cvtColor(frame, cv.COLOR_GRAY2BGR, dst=preview)
+            else:
+                np.copyto(preview, frame)
+
+        return dots
+
+    def _reset_correspondence_metrics(self):
+        self.correspondence_metrics = {
+            "frames": 0,
+            "totalTime": 0.0,
+            "maxTime": 0.0,
+            "totalHypotheses": 0,
+            "maxHypotheses": 0,
+            "cappedFrames": 0
+        }
 
-    def _camera_read(self):
-        frames, _ = self.cameras.read()
+    def _update_correspondence_metrics(self, metrics, elapsed_time):
+        with self.correspondence_metrics_lock:
+            self.correspondence_metrics["frames"] += 1
+            self.correspondence_metrics["totalTime"] += elapsed_time
+            self.correspondence_metrics["maxTime"] = max(self.correspondence_metrics["maxTime"], elapsed_time)
+            self.correspondence_metrics["totalHypotheses"] += metrics["hypotheses"]
+            self.correspondence_metrics["maxHypotheses"] = max(self.correspondence_metrics["maxHypotheses"], metrics["hypotheses"])
+            self.correspondence_metrics["cappedFrames"] += metrics["capped"]
+
+    def get_correspondence_metrics(self):
+        with self.correspondence_metrics_lock:
+            metrics = self.correspondence_metrics
+            self._reset_correspondence_metrics()
+
+        if metrics["frames"] == 0:
+            return None
+
+        return {
+            "frames": metrics["frames"],
+            "meanTimeMs": round(1000 * metrics["totalTime"] / metrics["frames"], 3),
+            "maxTimeMs": round(1000 * metrics["maxTime"], 3),
+            "meanHypotheses": round(metrics["totalHypotheses"] / metrics["frames"], 1),
+            "maxHypotheses": metrics["maxHypotheses"],
+            "cappedFrames": metrics["cappedFrames"]
+        }
+
+    def _get_detection_rois(self, capture_time):
+        # per camera lists of (x0, y0, x1, y1) windows to search for dots, None scans the full frame
+        if not (self.is_roi_detection and self.is_locating_objects and self.is_triangulating_points):
+            return None
+
+        self.frames_since_full_scan += 1
+        if self.roi_track_lost or self.frames_since_full_scan >= self.roi_full_scan_interval:
+            self.frames_since_full_scan = 0
+            return None
+
+        calibration = self.calibration
+        predicted_positions = self.tracker.predict_positions(capture_time)
+        # windows only around the drones tracked so far, drones that enter later are found by the periodic full scan
+        if calibration is None or len(predicted_positions) == 0:
+            return None
 
+        object_points = calibration.world_to_object_points([pos for _, pos in predicted_positions])
+
+        rois = []
         for i in range(0, self.num_cameras):
-            frames[i] = np.rot90(frames[i], k=self.camera_params[i]["rotation"])
-            frames[i] = make_square(frames[i])
-            frames[i] = cv.undistort(frames[i], self.get_camera_params(i)["intrinsic_matrix"], self.get_camera_params(i)["distortion_coef"])
-            frames[i] = cv.GaussianBlur(frames[i],(9,9),0)
-            kernel = np.array([[-2,-1,-1,-1,-2],
-                               [-1,1,3,1,-1],
-                               [-1,3,4,3,-1],
-                               [-1,1,3,1,-1],
-                               [-2,-1,-1,-1,-2]])
-            frames[i] = cv.filter2D(frames[i], -1, kernel)
-            frames[i] = cv.cvtColor(frames[i], cv.COLOR_RGB2BGR)
-
-        if (self.is_capturing_points):
-            image_points = []
-            for i in range(0, self.num_cameras):
-                frames[i], single_camera_image_points = self._find_dot(frames[i])
-                image_points.append(single_camera_image_points)
+            intrinsic_matrix = calibration.intrinsic_matrices[i]
+            size = self.camera_remaps[i]["map1"].shape[0]
+            camera_points = object_points @ calibration.camera_poses[i]["R"].T + calibration.camera_poses[i]["t"]
+            if np.any(camera_points[:, 2] <= 0):
+                return None
+            image_points = camera_points @ intrinsic_matrix.T
+            image_points = image_points[:, :2] / image_points[:, 2:]
+            radii = intrinsic_matrix[0,0] * self.roi_radius / camera_points[:, 2] + self.roi_margin
+
+            camera_rois = np.column_stack([image_points - radii[:, np.newaxis], image_points + radii[:, np.newaxis]])
+            camera_rois = np.clip(np.round(camera_rois), 0, size).astype(int)
+            rois.append(merge_rois(camera_rois.tolist()))
+
+        return rois
+
+    def _camera_read(self):
+        frames, timestamps = self.frame_source.read()
+        # capture time of every camera's frame, frames the source did not stamp are stamped on arrival
+        timestamps = np.array([time.time() if timestamp is None else timestamp for timestamp in timestamps], dtype=np.float64)
+        capture_time = float(np.median(timestamps))
+        tracer = self.latency_tracer
+        tracer.start_frame()
+        # source timestamps need not be on the wall clock, so only the capture stage compares against them, clamped at 0.
+        # total is timed with perf_counter alone, from the read to the last serial write
+        frame_start_time = time.perf_counter()
+        tracer.record("capture", max(time.time() - capture_time, 0))
+
+        if any(frame.shape[:2] != self.camera_remaps[i]["frame_shape"] for i, frame in enumerate(frames)):
+            self.frame_shape = frames[0].shape[:2]
+            for i in range(0, len(self.camera_params)):
+                self._update_camera_params(i)
+            self._allocate_frame_buffers()
+
+        # take a snapshot of the flags so every camera in this frame does the same work
+        is_capturing_points = self.is_capturing_points
+        render_preview = self.is_preview_enabled and not self.headless
+        rois = self._get_detection_rois(capture_time) if is_capturing_points else None
+        camera_nums = range(0, self.num_cameras)
+        find_dots = [is_capturing_points] * self.num_cameras
+        camera_rois = rois if rois is not None else [None] * self.num_cameras
+        mosaic, previews = None, [None] * self.num_cameras
+        if render_preview:
+            mosaic, previews = self.frame_buffers.next_mosaic(3 if self.colour or is_capturing_points else 1)
+        if self.worker_pool is None:
+            dots = list(map(self._process_frame, camera_nums, frames, find_dots, camera_rois, previews))
+        else:
+            dots = list(self.worker_pool.map(self._process_frame, camera_nums, frames, find_dots, camera_rois, previews))
+        for camera_dots, timestamp in zip(dots, timestamps):
+            if camera_dots is not None:
+                camera_dots["timestamp"] = timestamp
+        # the cameras run in parallel, the slowest one is what the frame waits for
+        tracer.record("preprocess", np.max(self.camera_stage_times[:, 0]))
+        if is_capturing_points:
+            tracer.record("detect", np.max(self.camera_stage_times[:, 1]))
+        epipolar_lines = None
+        self.roi_track_lost = True
+
+        if (is_capturing_points):
+            image_points = [camera_dots["image_points"] for camera_dots in dots]
             
             if (any(np.all(point[0] != [None,None]) for point in image_points)):
                 if self.is_capturing_points and not self.is_triangulating_points:
                     self.socketio.emit("image-points", [x[0] for x in image_points])
-                elif self.is_triangulating_points:
-                    errors, object_points, frames = find_point_correspondance_and_object_points(image_points, self.camera_poses, frames)
+                elif self.is_triangulating_points and self.calibration is not None:
+                    calibration = self.calibration
+                    correspondence_start_time = time.perf_counter()
+                    errors, object_points, image_point_groups, epipolar_lines, correspondence_metrics = find_point_correspondance_and_object_points(
+                        image_points, calibration, self.epipolar_tolerance, self.max_hypotheses
+                    )
+                    correspondence_time = time.perf_counter() - correspondence_start_time
+                    self._update_correspondence_metrics(correspondence_metrics, correspondence_time)
+                    tracer.record("correspondence", correspondence_time - correspondence_metrics["triangulateTime"])
+                    tracer.record("triangulate", correspondence_metrics["triangulateTime"])
+
+                    calibration_refiner = self.calibration_refiner
+                    if calibration_refiner is not None:
+                        calibration_refiner.add_observations(image_point_groups, errors)
 
                     # convert to world coordinates
-                    for i, object_point in enumerate(object_points):
-                        new_object_point = np.array([[-1,0,0],[0,-1,0],[0,0,1]]) @ object_point
-                        new_object_point = np.concatenate((new_object_point, [1]))
-                        new_object_point = np.array(self.to_world_coords_matrix) @ new_object_point
-                        new_object_point = new_object_point[:3] / new_object_point[3]
-                        new_object_point[1], new_object_point[2] = new_object_point[2], new_object_point[1]
-                        object_points[i] = new_object_point
+                    stage_start_time = time.perf_counter()
+                    if len(object_points) != 0:
+                        object_points = calibration.object_points_to_world(object_points)
+
+                    # every object point was captured at the mean time of the frames it was seen in
+                    views = np.array([[point[0] is not None for point in image_point_group] for image_point_group in image_point_groups], dtype=bool).reshape((-1, self.num_cameras))
+                    point_timestamps = views @ timestamps / np.maximum(np.sum(views, axis=1), 1)
+                    stage_start_time = tracer.record_since("triangulate", stage_start_time)
 
                     objects = []
                     filtered_objects = []
                     if self.is_locating_objects:
-                        objects = locate_objects(object_points, errors)
-                        filtered_objects = self.kalman_filter.predict_location(objects)
+                        objects = locate_objects(object_points, errors, timestamps=point_timestamps)
+                        stage_start_time = tracer.record_since("locate", stage_start_time)
+                        filtered_objects = self.tracker.update(objects, capture_time)
+                        stage_start_time = tracer.record_since("filter", stage_start_time)
+                        # a confirmed track that was not seen this frame makes the next frame a full scan
+                        self.roi_track_lost = any(filtered_object["isCoasting"] for filtered_object in filtered_objects)
                         
                         if len(filtered_objects) != 0:
                             for filtered_object in filtered_objects:
-                                if self.drone_armed[filtered_object['droneIndex']]:
+                                # coasting tracks are only predictions, never send them to the drones,
+                                # and without a serial port (index_no_serial) there is nobody to send positions to
+                                if self.ser is not None and self.drone_armed[filtered_object['droneIndex']] and not filtered_object["isCoasting"]:
                                     filtered_object["heading"] = round(filtered_object["heading"], 4)
 
+                                    # send where the drone is now rather than where it was when the frame was captured
+                                    pos = self.tracker.extrapolate(filtered_object["trackId"], time.time())
                                     serial_data = { 
-                                        "pos": [round(x, 4) for x in filtered_object["pos"].tolist()] + [filtered_object["heading"]],
+                                        "pos": [round(x, 4) for x in pos.tolist()] + [filtered_object["heading"]],
                                         "vel": [round(x, 4) for x in filtered_object["vel"].tolist()]
                                     }
+                                    serial_message = f"{filtered_object['droneIndex']}{json.dumps(serial_data)}".encode('utf-8')
+                                    stage_start_time = tracer.record_since("serialize", stage_start_time)
                                     with self.serialLock:
-                                        self.ser.write(f"{filtered_object['droneIndex']}{json.dumps(serial_data)}".encode('utf-8'))
+                                        self.ser.write(serial_message)
                                         time.sleep(0.001)
+                                    stage_start_time = tracer.record_since("write", stage_start_time)
+
+                        tracer.record("total", time.perf_counter() - frame_start_time)
                             
                         for filtered_object in filtered_objects:
                             filtered_object["vel"] = filtered_object["vel"].tolist()
@@ -128,39 +403,60 @@ class Cameras:
                     self.socketio.emit("object-points", {
                         "object_points": object_points.tolist(), 
                         "errors": errors.tolist(), 
+                        "timestamps": point_timestamps.tolist(),
                         "objects": [{k:(v.tolist() if isinstance(v, np.ndarray) else v) for (k,v) in object.items()} for object in objects], 
                         "filtered_objects": filtered_objects
                     })
+
+        tracer.end_frame()
+
+        if not render_preview:
+            return None
+
+        if is_capturing_points:
+            for i in range(0, self.num_cameras):
+                draw_dots(previews[i], dots[i])
+                if epipolar_lines is not None and len(epipolar_lines[i]) != 0:
+                    drawlines(previews[i], epipolar_lines[i])
         
-        return frames
+        return mosaic
 
     def get_frames(self):
-        frames = self._camera_read()
+        # the previews side by side, None when no preview is rendered
         #frames = [add_white_border(frame, 5) for frame in frames]
 
-        return np.hstack(frames)
+        return self._camera_read()
 
-    def _find_dot(self, img):
+    def _find_dot(self, img, rois=None, buffers=None):
         # img = cv.GaussianBlur(img,(5,5),0)
-        grey = cv.cvtColor(img, cv.COLOR_RGB2GRAY)
-        grey = cv.threshold(grey, 255*0.2, 255, cv.THRESH_BINARY)[1]
-        contours,_ = cv.findContours(grey, cv.RETR_TREE, cv.CHAIN_APPROX_SIMPLE)
-        img = cv.drawContours(img, contours, -1, (0,255,0), 1)
-
-        image_points = []
-        for contour in contours:
-            moments = cv.moments(contour)
-            if moments["m00"] != 0:
-                center_x = int(moments["m10"] / moments["m00"])
-                center_y = int(moments["m01"] / moments["m00"])
-                cv.putText(img, f'({center_x}, {center_y})', (center_x,center_y - 15), cv.FONT_HERSHEY_SIMPLEX, 0.3, (100,255,100), 1)
-                cv.circle(img, (center_x,center_y), 1, (100,255,100), -1)
-                image_points.append([center_x, center_y])
-
+        # mono frames are thresholded as is, colour frames are still RGB here
+        if buffers is None:
+            buffers = {"grey": None, "binary": None, "labels": None}
+        if rois is None:
+            grey = img if img.ndim == 2 else cv.cvtColor(img, cv.COLOR_BGR2GRAY, dst=buffers["grey"])
+            centroids, _, bounding_boxes = find_blobs(grey, 255*0.2, self.blob_min_area, self.blob_max_area, buffers["binary"], buffers["labels"])
+        else:
+            # only threshold and label the windows around the predicted drones
+            centroids = [np.empty((0, 2))]
+            bounding_boxes = [np.empty((0, 4), dtype=int)]
+            for x0, y0, x1, y1 in rois:
+                grey_roi = img[y0:y1, x0:x1] if img.ndim == 2 else cv.cvtColor(img[y0:y1, x0:x1], cv.COLOR_BGR2GRAY)
+                roi_centroids, _, roi_bounding_boxes = find_blobs(grey_roi, 255*0.2, self.blob_min_area, self.blob_max_area)
+                centroids.append(roi_centroids + [x0, y0])
+                bounding_boxes.append(roi_bounding_boxes + [x0, y0, 0, 0])
+            centroids = np.concatenate(centroids)
+            bounding_boxes = np.concatenate(bounding_boxes)
+
+        image_points = centroids.tolist()
         if len(image_points) == 0:
             image_points = [[None, None]]
 
-        return img, image_points
+        return {
+            "image_points": image_points,
+            "centroids": centroids,
+            "bounding_boxes": bounding_boxes,
+            "rois": rois
+        }
 
     def start_capturing_points(self):
         self.is_capturing_points = True
@@ -171,26 +467,33 @@ class Cameras:
     def start_trangulating_points(self, camera_poses):
         self.is_capturing_points = True
         self.is_triangulating_points = True
-        self.camera_poses = camera_poses
-        self.kalman_filter = KalmanFilter(self.num_objects)
+        with self.calibration_lock:
+            self.camera_poses = camera_poses
+            self._update_calibration()
+        self.tracker = Tracker(self.num_objects)
 
     def stop_trangulating_points(self):
         self.is_capturing_points = False
         self.is_triangulating_points = False
-        self.camera_poses = None
+        with self.calibration_lock:
+            self.camera_poses = None
+            self._update_calibration()
 
     def start_locating_objects(self):
         self.is_locating_objects = True
+        self.roi_track_lost = True
+
+    def start_roi_detection(self):
+        self.is_roi_detection = True
+
+    def stop_roi_detection(self):
+        self.is_roi_detection = False
 
     def stop_locating_objects(self):
         self.is_locating_objects = False
     
     def get_camera_params(self, camera_num):
-        return {
-            "intrinsic_matrix": np.array(self.camera_params[camera_num]["intrinsic_matrix"]),
-            "distortion_coef": np.array(self.camera_params[camera_num]["distortion_coef"]),
-            "rotation": self.camera_params[camera_num]["rotation"]
-        }
+        return self.camera_params_arrays[camera_num]
     
     def set_camera_params(self, camera_num, intrinsic_matrix=None, distortion_coef=None):
         if intrinsic_matrix is not None:
@@ -199,287 +502,601 @@ class Cameras:
         if distortion_coef is not None:
             self.camera_params[camera_num]["distortion_coef"] = distortion_coef
 
+        if intrinsic_matrix is not None or distortion_coef is not None:
+            self._update_camera_params(camera_num)
+            self._update_calibration()
 
-def calculate_reprojection_errors(image_points, object_points, camera_poses):
-    errors = np.array([])
-    for image_points_i, object_point in zip(image_points, object_points):
-        error = calculate_reprojection_error(image_points_i, object_point, camera_poses)
-        if error is None:
-            continue
-        errors = np.concatenate([errors, [error]])
+    def _update_camera_params(self, camera_num):
+        camera_params = {
+            "intrinsic_matrix": np.array(self.camera_params[camera_num]["intrinsic_matrix"], dtype=np.float64),
+            "distortion_coef": np.array(self.camera_params[camera_num]["distortion_coef"], dtype=np.float64),
+            "rotation": self.camera_params[camera_num]["rotation"]
+        }
+        self.camera_params_arrays[camera_num] = camera_params
+        self.camera_remaps[camera_num] = build_camera_remap(
+            camera_params["intrinsic_matrix"], 
+            camera_params["distortion_coef"], 
+            camera_params["rotation"], 
+            self.frame_shape,
+            channels=3 if self.colour else 1
+        )
 
-    return errors
 
+def calculate_reprojection_errors(image_points, object_points, camera_poses, intrinsic_matrices=None):
+    # points seen by fewer than two cameras have no error and are left out
+    image_points = image_points_to_array(image_points)
+    object_points = np.array(object_points, dtype=np.float64).reshape((-1, 3))
+    errors = reprojection_errors_batch(image_points, object_points, get_projection_matrices(camera_poses, intrinsic_matrices))
 
-def calculate_reprojection_error(image_points, object_point, camera_poses):
-    cameras = Cameras.instance()
+    return errors[np.sum(~np.isnan(image_points[:, :, 0]), axis=1) > 1]
 
-    image_points = np.array(image_points)
-    none_indicies = np.where(np.all(image_points == None, axis=1))[0]
-    image_points = np.delete(image_points, none_indicies, axis=0)
-    camera_poses = np.delete(camera_poses, none_indicies, axis=0)
 
-    if len(image_points) <= 1:
+def calculate_reprojection_error(image_points, object_point, camera_poses):
+    errors = calculate_reprojection_errors([image_points], [object_point], camera_poses)
+    if len(errors) == 0:
         return None
 
-    image_points_t = image_points.transpose((0,1))
+    return errors[0]
 
-    errors = np.array([])
-    for i, camera_pose in enumerate(camera_poses):
-        if np.all(image_points[i] == None, axis=0):
-            continue
-        projected_img_points, _ = cv.projectPoints(
-            np.expand_dims(object_point, axis=0).astype(np.float32), 
-            np.array(camera_pose["R"], dtype=np.float64), 
-            np.array(camera_pose["t"], dtype=np.float64), 
-            cameras.get_camera_params(i)["intrinsic_matrix"], 
-            np.array([])
-        )
-        projected_img_point = projected_img_points[:,0,:][0]
-        errors = np.concatenate([errors, (image_points_t[i]-projected_img_point).flatten() ** 2])
-    
-    return errors.mean()
+
+def reproject_points(object_points, Ps):
+    # (N, 3) object points through (C, 3, 4) projection matricies to (N, C, 2) image points
+    image_points = np.einsum("cij,nj->nci", Ps[:, :, :3], object_points) + Ps[:, :, 3]
+
+    return image_points[:, :, :2] / image_points[:, :, 2:]
+
+
+def reprojection_errors_batch(image_points, object_points, Ps):
+    # mean squared error per point over the cameras that saw it, NaN image points are not visible, NaN when seen by fewer than two cameras
+    visible = ~np.isnan(image_points[:, :, 0])
+    num_visible = np.sum(visible, axis=1)
+    residuals = np.where(visible[:, :, np.newaxis], reproject_points(object_points, Ps) - image_points, 0)
+
+    errors = np.sum(residuals**2, axis=(1, 2)) / np.maximum(2*num_visible, 1)
+    errors[num_visible <= 1] = np.nan
+
+    return errors
 
 
-def bundle_adjustment(image_points, camera_poses, socketio):
-    cameras = Cameras.instance()
+def bundle_adjustment(image_points, camera_poses, on_progress=None, intrinsic_matrices=None, optimize_points=False, progress_interval=0.5, max_nfev=None, verbose=2):
+    # camera 0 stays at the origin, every other camera has a rotation vector and translation. Residuals are the pixel
+    # reprojection errors of every observation. With optimize_points the 3D points are solved for jointly, otherwise they
+    # are re-triangulated from the current poses. on_progress receives the latest camera poses every progress_interval seconds
+    image_points = image_points_to_array(image_points)
+    num_cameras = len(camera_poses)
+    if intrinsic_matrices is None:
+        cameras = Cameras.instance()
+        intrinsic_matrices = [cameras.get_camera_params(i)["intrinsic_matrix"] for i in range(0, num_cameras)]
+    intrinsic_matrices = np.array(intrinsic_matrices[:num_cameras], dtype=np.float64)
+
+    # only points seen by at least two cameras constrain the poses
+    image_points = image_points[np.sum(~np.isnan(image_points[:, :, 0]), axis=1) > 1]
+    point_indices, camera_indices = np.nonzero(~np.isnan(image_points[:, :, 0]))
+    observed_points = image_points[point_indices, camera_indices]
+    num_points = len(image_points)
+    num_camera_params = 6*(num_cameras-1)
 
     def params_to_camera_poses(params):
-        focal_distances = []
-        num_cameras = int((params.size-1)/7)+1
         camera_poses = [{
             "R": np.eye(3),
             "t": np.array([0,0,0], dtype=np.float32)
         }]
-        focal_distances.append(params[0])
         for i in range(0, num_cameras-1):
-            focal_distances.append(params[i*7+1])
             camera_poses.append({
-                "R": Rotation.as_matrix(Rotation.from_rotvec(params[i*7 + 2 : i*7 + 3 + 2])),
-                "t": params[i*7 + 3 + 2 : i*7 + 6 + 2]
+                "R": Rotation.as_matrix(Rotation.from_rotvec(params[i*6 : i*6 + 3])),
+                "t": params[i*6 + 3 : i*6 + 6]
             })
 
-        return camera_poses, focal_distances
+        return camera_poses
 
     def residual_function(params):
-        camera_poses, focal_distances = params_to_camera_poses(params)
-        for i in range(0, len(camera_poses)):
-            intrinsic = cameras.get_camera_params(i)["intrinsic_matrix"]
-            intrinsic[0, 0] = focal_distances[i]
-            intrinsic[1, 1] = focal_distances[i]
-            # cameras.set_camera_params(i, intrinsic)
-        object_points = triangulate_points(image_points, camera_poses)
-        errors = calculate_reprojection_errors(image_points, object_points, camera_poses)
-        errors = errors.astype(np.float32)
-        socketio.emit("camera-pose", {"camera_poses": camera_pose_to_serializable(camera_poses)})
-        
-        return errors
-
-    focal_distance = cameras.get_camera_params(0)["intrinsic_matrix"][0,0]
-    init_params = np.array([focal_distance])
-    for i, camera_pose in enumerate(camera_poses[1:]):
-        rot_vec = Rotation.as_rotvec(Rotation.from_matrix(camera_pose["R"])).flatten()
-        focal_distance = cameras.get_camera_params(i)["intrinsic_matrix"][0,0]
-        init_params = np.concatenate([init_params, [focal_distance]])
-        init_params = np.concatenate([init_params, rot_vec])
-        init_params = np.concatenate([init_params, camera_pose["t"].flatten()])
-
-    res = optimize.least_squares(
-        residual_function, init_params, verbose=2, loss="cauchy", ftol=1E-2
-    )
-    return params_to_camera_poses(res.x)[0]
+        camera_poses = params_to_camera_poses(params)
+        Ps = get_projection_matrices(camera_poses, intrinsic_matrices)
+        if optimize_points:
+            object_points = params[num_camera_params:].reshape((num_points, 3))
+        else:
+            object_points = triangulate_points_batch(image_points, Ps)
+
+        projected_points = np.einsum("nij,nj->ni", Ps[camera_indices], np.c_[object_points[point_indices], np.ones(len(point_indices))])
+        residuals = projected_points[:, :2] / projected_points[:, 2:] - observed_points
+
+        if progress_reporter is not None:
+            progress_reporter.update(params[:num_camera_params].copy())
+
+        return residuals.flatten()
+
+    # each observation depends on its own camera and point, or on every camera that saw the point when it is re-triangulated
+    rows, columns = [], []
+    observations = np.arange(0, len(point_indices))
+    for i in range(1, num_cameras):
+        is_dependent = camera_indices == i if optimize_points else ~np.isnan(image_points[point_indices, i, 0])
+        for k in range(0, 6):
+            rows += [2*observations[is_dependent], 2*observations[is_dependent] + 1]
+            columns += [np.full(2*np.sum(is_dependent), (i-1)*6 + k)]
+    if optimize_points:
+        for k in range(0, 3):
+            rows += [2*observations, 2*observations + 1]
+            columns += [num_camera_params + 3*point_indices + k]*2
+    rows, columns = np.concatenate(rows), np.concatenate(columns)
+    jac_sparsity = sparse.coo_matrix(
+        (np.ones(len(rows), dtype=int), (rows, columns)),
+        shape=(2*len(point_indices), num_camera_params + (3*num_points if optimize_points else 0))
+    ).tocsr()
+
+    init_params = []
+    for camera_pose in camera_poses[1:]:
+        init_params.append(Rotation.as_rotvec(Rotation.from_matrix(np.array(camera_pose["R"], dtype=np.float64))).flatten())
+        init_params.append(np.array(camera_pose["t"], dtype=np.float64).flatten())
+    if optimize_points:
+        init_params.append(triangulate_points_batch(image_points, get_projection_matrices(camera_poses, intrinsic_matrices)).flatten())
+    init_params = np.concatenate(init_params)
+
+    progress_reporter = None
+    if on_progress is not None:
+        progress_reporter = ProgressReporter(lambda params: on_progress(params_to_camera_poses(params)), progress_interval)
+        progress_reporter.start()
+
+    try:
+        res = optimize.least_squares(
+            residual_function, init_params, jac_sparsity=jac_sparsity, loss="soft_l1", f_scale=2.0, ftol=1E-4, method="trf", max_nfev=max_nfev, verbose=verbose
+        )
+    finally:
+        if progress_reporter is not None:
+            progress_reporter.stop()
+
+    return params_to_camera_poses(res.x)
     
 
-def triangulate_point(image_points, camera_poses):
-    image_points = np.array(image_points)
-    cameras = Cameras.instance()
-    none_indicies = np.where(np.all(image_points == None, axis=1))[0]
-    image_points = np.delete(image_points, none_indicies, axis=0)
-    camera_poses = np.delete(camera_poses, none_indicies, axis=0)
+def calculate_camera_poses(image_points, intrinsic_matrices, on_progress=None, target_sample_count=1000, image_sizes=None):
+    # initial poses from the fundamental matrix between each pair of neighbouring cameras, chained from camera 0,
+    # then refined by bundle adjustment on at most target_sample_count spatially balanced samples.
+    # image_sizes are the (width, height) of every camera's frame the points were detected in, by default the extent of the points.
+    # Returns the camera poses and a report with the reprojection errors and sample counts
+    image_points = image_points_to_array(image_points)
+    num_cameras = image_points.shape[1]
+
+    camera_poses = [{
+        "R": np.eye(3),
+        "t": np.array([[0],[0],[0]], dtype=np.float32)
+    }]
+    for camera_i in range(0, num_cameras-1):
+        is_seen_by_both = np.all(~np.isnan(image_points[:, camera_i:camera_i+2, 0]), axis=1)
+        camera1_image_points = image_points[is_seen_by_both, camera_i].astype(np.float32)
+        camera2_image_points = image_points[is_seen_by_both, camera_i+1].astype(np.float32)
+
+        F, _ = cv.findFundamentalMat(camera1_image_points, camera2_image_points, cv.FM_RANSAC, 1, 0.99999)
+        E = np.array(intrinsic_matrices[camera_i+1]).T @ F @ np.array(intrinsic_matrices[camera_i])
+        R1, R2, t = cv.decomposeEssentialMat(E)
+        possible_Rs, possible_ts = [R1, R1, R2, R2], [t, -t, t, -t]
+
+        # the pair is triangulated in camera i's frame, the right motion puts the points in front of both cameras
+        R = None
+        t = None
+        max_points_infront_of_camera = 0
+        for i in range(0, 4):
+            object_points = triangulate_points(
+                np.stack([camera1_image_points, camera2_image_points], axis=1), 
+                [{"R": np.eye(3), "t": np.zeros(3)}, {"R": possible_Rs[i], "t": possible_ts[i]}],
+                intrinsic_matrices[camera_i:camera_i+2]
+            )
+            object_points_camera_coordinate_frame = object_points @ possible_Rs[i].T + possible_ts[i].flatten()
+
+            points_infront_of_camera = np.sum(object_points[:,2] > 0) + np.sum(object_points_camera_coordinate_frame[:,2] > 0)
+
+            if points_infront_of_camera > max_points_infront_of_camera:
+                max_points_infront_of_camera = points_infront_of_camera
+                R = possible_Rs[i]
+                t = possible_ts[i]
+
+        R = R @ camera_poses[-1]["R"]
+        t = camera_poses[-1]["t"] + (camera_poses[-1]["R"] @ t)
+
+        camera_poses.append({
+            "R": R,
+            "t": t
+        })
+
+    if image_sizes is None:
+        image_sizes = np.nanmax(image_points, axis=0) + 1
+    selected, held_out = subsample_calibration_points(image_points, camera_poses, intrinsic_matrices, image_sizes, target_sample_count)
+
+    start_time = time.perf_counter()
+    camera_poses = bundle_adjustment(image_points[selected], camera_poses, on_progress, intrinsic_matrices, optimize_points=True)
+    bundle_adjustment_time = time.perf_counter() - start_time
+
+    object_points = triangulate_points(image_points, camera_poses, intrinsic_matrices)
+    errors = reprojection_errors_batch(image_points, object_points, get_projection_matrices(camera_poses, intrinsic_matrices))
+    report = {
+        "error": float(np.nanmean(errors)),
+        "heldOutError": float(np.nanmean(errors[held_out])) if len(held_out) != 0 else None,
+        "samples": len(image_points),
+        "selectedSamples": len(selected),
+        "observations": int(np.sum(~np.isnan(image_points[:, :, 0]))),
+        "selectedObservations": int(np.sum(~np.isnan(image_points[selected, :, 0]))),
+        "bundleAdjustmentTime": round(bundle_adjustment_time, 3) # seconds
+    }
+
+    return camera_poses, report
+
+
+def subsample_calibration_points(image_points, camera_poses, intrinsic_matrices, image_sizes, target_sample_count, image_grid_size=8, seed=0):
+    # pick at most target_sample_count samples spread evenly over the tracked volume and over every camera's image.
+    # Samples are bucketed by the voxel of their triangulated point, voxels are visited round robin and each time the
+    # sample in the voxel whose image grid cells are least covered so far is taken. Returns the selected sample indices
+    # and a held out set of unselected samples to validate the solve on
+    rng = np.random.default_rng(seed)
+    object_points = triangulate_points_batch(image_points, get_projection_matrices(camera_poses, intrinsic_matrices))
+    usable = np.nonzero(np.all(np.isfinite(object_points), axis=1))[0]
+    if len(usable) <= target_sample_count:
+        return usable, np.array([], dtype=int)
+
+    # voxel size chosen so the occupied bounding box holds about target_sample_count voxels
+    low, high = np.percentile(object_points[usable], [1, 99], axis=0)
+    extents = np.maximum(high - low, max(0.05 * np.max(high - low), 1e-6))
+    voxel_size = (np.prod(extents) / target_sample_count) ** (1/3)
+    voxels = np.floor((np.clip(object_points[usable], low, high) - low) / voxel_size).astype(int)
+    _, voxel_indices = np.unique(voxels, axis=0, return_inverse=True)
+    voxel_indices = voxel_indices.flatten()
+
+    # image grid cell of every sample in every camera, -1 when the camera did not see it
+    image_sizes = np.array(image_sizes, dtype=np.float64).reshape((image_points.shape[1], 2))
+    cells = np.floor(image_points[usable] / image_sizes * image_grid_size)
+    cells = np.clip(np.nan_to_num(cells, nan=-1), -1, image_grid_size - 1).astype(int)
+    cells = np.where(cells[:, :, 0] >= 0, cells[:, :, 1] * image_grid_size + cells[:, :, 0], -1)
+    cell_counts = np.zeros((image_points.shape[1], image_grid_size**2 + 1))
+    camera_nums = np.arange(0, image_points.shape[1])
+
+    voxel_samples = [[] for _ in range(0, voxel_indices.max() + 1)]
+    for sample in rng.permutation(len(usable)):
+        voxel_samples[voxel_indices[sample]].append(sample)
+    voxel_samples = [np.array(samples) for samples in voxel_samples]
+
+    selected = []
+    while len(selected) < target_sample_count:
+        for v, samples in enumerate(voxel_samples):
+            if len(samples) == 0 or len(selected) >= target_sample_count:
+                continue
+            # unseen cameras land in the spare last column and never count
+            coverage = np.sum(cell_counts[camera_nums, cells[samples]] * (cells[samples] >= 0), axis=1)
+            best = np.argmin(coverage)
+            sample = samples[best]
+            voxel_samples[v] = np.delete(samples, best)
+
+            selected.append(sample)
+            cell_counts[camera_nums, cells[sample]] += 1
+
+    is_selected = np.zeros(len(usable), dtype=bool)
+    is_selected[selected] = True
+    held_out = rng.permutation(np.nonzero(~is_selected)[0])[:max(target_sample_count // 4, 1)]
+
+    return usable[np.sort(selected)], usable[held_out]
 
-    if len(image_points) <= 1:
-        return [None, None, None]
 
-    Ps = [] # projection matricies
 
-    for i, camera_pose in enumerate(camera_poses):
-        RT = np.c_[camera_pose["R"], camera_pose["t"]]
-        P = cameras.camera_params[i]["intrinsic_matrix"] @ RT
-        Ps.append(P)
 
-    # https://temugeb.github.io/computer_vision/2021/02/06/direct-linear-transorms.html
-    def DLT(Ps, image_points):
-        A = []
+def triangulate_point(image_points, camera_poses):
+    return triangulate_points([image_points], camera_poses)[0]
 
-        for P, image_point in zip(Ps, image_points):
-            A.append(image_point[1]*P[2,:] - P[1,:])
-            A.append(P[0,:] - image_point[0]*P[2,:])
-            
-        A = np.array(A).reshape((len(Ps)*2,4))
-        B = A.transpose() @ A
-        U, s, Vh = linalg.svd(B, full_matrices = False)
-        object_point = Vh[3,0:3]/Vh[3,3]
 
-        return object_point
+def triangulate_points(image_points, camera_poses, intrinsic_matrices=None):
+    # rows with fewer than two image points come back as NaN
+    return triangulate_points_batch(image_points_to_array(image_points), get_projection_matrices(camera_poses, intrinsic_matrices))
 
-    object_point = DLT(Ps, image_points)
 
-    return object_point
+def get_projection_matrices(camera_poses, intrinsic_matrices=None):
+    if intrinsic_matrices is None:
+        cameras = Cameras.instance()
+        intrinsic_matrices = [cameras.get_camera_params(i)["intrinsic_matrix"] for i in range(0, len(camera_poses))]
 
+    Ps = [] # projection matricies
+    for intrinsic_matrix, camera_pose in zip(intrinsic_matrices, camera_poses):
+        RT = np.c_[np.array(camera_pose["R"], dtype=np.float64), np.array(camera_pose["t"], dtype=np.float64).reshape((3, 1))]
+        Ps.append(np.array(intrinsic_matrix, dtype=np.float64) @ RT)
 
-def triangulate_points(image_points, camera_poses):
-    object_points = []
-    for image_points_i in image_points:
-        object_point = triangulate_point(image_points_i, camera_poses)
-        object_points.append(object_point)
-    
-    return np.array(object_points)
+    return np.array(Ps)
+
+
+def image_points_to_array(image_points):
+    # [point][camera] lists using [None, None] for missing points to a (N, C, 2) float array using NaN
+    image_points = np.array(image_points, dtype=object)
+    if image_points.size == 0:
+        return np.empty((0, 0, 2))
+    image_points = image_points.reshape((image_points.shape[0], -1, 2))
+    image_points[image_points == None] = np.nan
 
+    return image_points.astype(np.float64)
 
-def find_point_correspondance_and_object_points(image_points, camera_poses, frames):
-    cameras = Cameras.instance()
 
+def triangulate_points_batch(image_points, Ps):
+    # https://temugeb.github.io/computer_vision/2021/02/06/direct-linear-transorms.html
+    # image_points is (N, C, 2) with NaN for missing points, Ps is (C, 3, 4). Every DLT system is
+    # built and solved at once, missing points contribute zero rows
+    valid = ~np.any(np.isnan(image_points), axis=2)
+    image_points = np.where(valid[:, :, np.newaxis], image_points, 0)
+
+    A = np.stack([
+        image_points[:, :, 1, np.newaxis]*Ps[np.newaxis, :, 2, :] - Ps[np.newaxis, :, 1, :],
+        Ps[np.newaxis, :, 0, :] - image_points[:, :, 0, np.newaxis]*Ps[np.newaxis, :, 2, :]
+    ], axis=2) * valid[:, :, np.newaxis, np.newaxis]
+    A = A.reshape((len(image_points), 2*len(Ps), 4))
+    B = np.einsum("nji,njk->nik", A, A)
+
+    # B is symmetric, the eigenvector of its smallest eigenvalue is the last right singular vector
+    _, eigenvectors = np.linalg.eigh(B)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        object_points = eigenvectors[:, 0:3, 0] / eigenvectors[:, 3:4, 0]
+    object_points[np.sum(valid, axis=1) <= 1] = np.nan
+
+    return object_points
+
+
+def find_point_correspondance_and_object_points(image_points, calibration, epipolar_tolerance=5, max_hypotheses=256):
+    # every image point is used by at most one object point. Hypotheses are grown from the lowest cost camera pairs
+    # and capped at max_hypotheses, so a frame full of reflections costs the same as a frame of drones
+    camera_points = []
     for image_points_i in image_points:
-        try:
-            image_points_i.remove([None, None])
-        except:
-            pass
+        points = np.array([point for point in image_points_i if point[0] is not None], dtype=np.float64)
+        camera_points.append(points.reshape((-1, 2)))
 
-    # [object_points, possible image_point groups, image_point from camera]
-    correspondances = [[[i]] for i in image_points[0]]
+    epipolar_costs = get_epipolar_costs(camera_points, calibration, epipolar_tolerance)
 
-    Ps = [] # projection matricies
-    for i, camera_pose in enumerate(camera_poses):
-        RT = np.c_[camera_pose["R"], camera_pose["t"]]
-        P = cameras.camera_params[i]["intrinsic_matrix"] @ RT
-        Ps.append(P)
-
-    root_image_points = [{"camera": 0, "point": point} for point in image_points[0]]
-
-    for i in range(1, len(camera_poses)):
-        epipolar_lines = []
-        for root_image_point in root_image_points:
-            F = cv.sfm.fundamentalFromProjections(Ps[root_image_point["camera"]], Ps[i])
-            line = cv.computeCorrespondEpilines(np.array([root_image_point["point"]], dtype=np.float32), 1, F)
-            epipolar_lines.append(line[0,0].tolist())
-            frames[i] = drawlines(frames[i], line[0])
-
-        not_closest_match_image_points = np.array(image_points[i])
-        points = np.array(image_points[i])
-
-        for j, [a, b, c] in enumerate(epipolar_lines):
-            distances_to_line = np.array([])
-            if len(points) != 0:
-                distances_to_line = np.abs(a*points[:,0] + b*points[:,1] + c) / np.sqrt(a**2 + b**2)
-
-            possible_matches = points[distances_to_line < 5].copy()
-
-            # Commenting out this code produces more points, but more garbage points too
-            # delete closest match from future consideration
-            # if len(points) != 0:
-            #     points = np.delete(points, np.argmin(distances_to_line), axis=0)
-
-            # sort possible matches from smallest to largest
-            distances_to_line = distances_to_line[distances_to_line < 5]
-            possible_matches_sorter = distances_to_line.argsort()
-            possible_matches = possible_matches[possible_matches_sorter]
-    
-            if len(possible_matches) == 0:
-                for possible_group in correspondances[j]:
-                    possible_group.append([None, None])
+    seeds = []
+    for (i, j), costs in epipolar_costs.items():
+        if i > j:
+            continue
+        for a, costs_a in enumerate(costs):
+            for b, cost in costs_a.items():
+                seeds.append((cost, i, a, j, b))
+    seeds.sort(key=lambda seed: seed[0])
+
+    # a point seen by n cameras seeds every one of its n*(n-1)/2 camera pairs, seeds whose pair is already part of
+    # a grown hypothesis would grow into it again and don't count against max_hypotheses
+    num_candidates = len(seeds)
+    num_grown = 0
+    hypotheses = []
+    seen_hypotheses = set()
+    grown_pairs = set()
+    is_capped = False
+    for _, i, a, j, b in seeds:
+        if (i, a, j, b) in grown_pairs:
+            continue
+        if num_grown == max_hypotheses:
+            is_capped = True
+            break
+        num_grown += 1
+
+        hypothesis = grow_hypothesis({i: a, j: b}, camera_points, epipolar_costs)
+        key = tuple(sorted(hypothesis.items()))
+        if key in seen_hypotheses:
+            continue
+        seen_hypotheses.add(key)
+        hypotheses.append(hypothesis)
+        grown_pairs.update((i, a, j, b) for (i, a), (j, b) in itertools.combinations(key, 2))
+
+    hypothesis_image_points = np.full((len(hypotheses), calibration.num_cameras, 2), np.nan)
+    for h, hypothesis in enumerate(hypotheses):
+        for camera_num, point_index in hypothesis.items():
+            hypothesis_image_points[h, camera_num] = camera_points[camera_num][point_index]
+
+    triangulate_start_time = time.perf_counter()
+    object_points = triangulate_points_batch(hypothesis_image_points, calibration.Ps)
+    errors = reprojection_errors_batch(hypothesis_image_points, object_points, calibration.Ps)
+    triangulate_time = time.perf_counter() - triangulate_start_time
+
+    # prefer hypotheses seen by more cameras, then the lowest reprojection error
+    chosen = []
+    used_points = set()
+    for h in sorted(range(0, len(hypotheses)), key=lambda h: (-len(hypotheses[h]), errors[h])):
+        if np.isnan(errors[h]) or any(point in used_points for point in hypotheses[h].items()):
+            continue
+        used_points.update(hypotheses[h].items())
+        chosen.append(h)
+
+    image_point_groups = [[[None, None] if np.isnan(point[0]) else point.tolist() for point in hypothesis_image_points[h]] for h in chosen]
+
+    # kept for the preview overlay, the lines of every camera 0 point
+    camera_epipolar_lines = [[] for _ in range(0, calibration.num_cameras)]
+    if len(camera_points[0]) != 0:
+        for i in range(1, calibration.num_cameras):
+            camera_epipolar_lines[i] = calibration.epipolar_lines(camera_points[0], 0, i).tolist()
+
+    metrics = {
+        "candidates": num_candidates,
+        "hypotheses": len(hypotheses),
+        "capped": is_capped,
+        "triangulateTime": triangulate_time
+    }
+
+    return errors[chosen], object_points[chosen].reshape((-1, 3)), image_point_groups, camera_epipolar_lines, metrics
+
+
+def get_epipolar_costs(camera_points, calibration, epipolar_tolerance, epipolar_index_min_pairs=16384):
+    # symmetric epipolar distance in pixels for every pair of points in every pair of cameras that is below the tolerance,
+    # epipolar_costs[(i, j)][a] maps point b in camera j to its cost with point a in camera i.
+    # Small camera pairs are compared directly, larger ones go through an EpipolarIndex
+    epipolar_costs = {}
+    for i in range(0, len(camera_points)):
+        for j in range(i+1, len(camera_points)):
+            if len(camera_points[i]) == 0 or len(camera_points[j]) == 0:
+                continue
+
+            lines_ij = calibration.epipolar_lines(camera_points[i], i, j)
+            lines_ji = calibration.epipolar_lines(camera_points[j], j, i)
+            if len(camera_points[i]) * len(camera_points[j]) <= epipolar_index_min_pairs:
+                distances_j = np.abs(lines_ij[:, :2] @ camera_points[j].T + lines_ij[:, 2:])
+                distances_i = np.abs(lines_ji[:, :2] @ camera_points[i].T + lines_ji[:, 2:]).T
+                costs = (distances_j + distances_i) / 2
+                a, b = np.nonzero(costs < epipolar_tolerance)
+                costs = costs[a, b]
             else:
-                not_closest_match_image_points = [row for row in not_closest_match_image_points.tolist() if row != possible_matches.tolist()[0]]
-                not_closest_match_image_points = np.array(not_closest_match_image_points)
-                
-                new_correspondances_j = []
-                for possible_match in possible_matches:
-                    temp = copy.deepcopy(correspondances[j])
-                    for possible_group in temp:
-                        possible_group.append(possible_match.tolist())
-                    new_correspondances_j += temp
-                correspondances[j] = new_correspondances_j
-
-        for not_closest_match_image_point in not_closest_match_image_points:
-            root_image_points.append({"camera": i, "point": not_closest_match_image_point})
-            temp = [[[None, None]] * i]
-            temp[0].append(not_closest_match_image_point.tolist())
-            correspondances.append(temp)
-
-    object_points = []
-    errors = []
-    for image_points in correspondances:
-        object_points_i = triangulate_points(image_points, camera_poses)
-
-        if np.all(object_points_i == None):
+                # a symmetric distance below the tolerance needs both one sided distances below twice the tolerance
+                epipolar_index = EpipolarIndex(camera_points[j], calibration.epipoles[i][j], 2*epipolar_tolerance)
+                a, b, distances_j = epipolar_index.query_lines(lines_ij)
+                distances_i = np.abs(np.sum(lines_ji[b, :2] * camera_points[i][a], axis=1) + lines_ji[b, 2])
+                costs = (distances_j + distances_i) / 2
+                matches = costs < epipolar_tolerance
+                a, b, costs = a[matches], b[matches], costs[matches]
+
+            costs_ij = [{} for _ in camera_points[i]]
+            costs_ji = [{} for _ in camera_points[j]]
+            for a, b, cost in zip(a.tolist(), b.tolist(), costs.tolist()):
+                costs_ij[a][b] = cost
+                costs_ji[b][a] = cost
+
+            epipolar_costs[(i, j)] = costs_ij
+            epipolar_costs[(j, i)] = costs_ji
+
+    return epipolar_costs
+
+
+def grow_hypothesis(hypothesis, camera_points, epipolar_costs):
+    # add the point from each remaining camera that agrees with every point already in the hypothesis
+    for k in range(0, len(camera_points)):
+        if k in hypothesis or any((camera_num, k) not in epipolar_costs for camera_num in hypothesis):
+            continue
+        member_costs = [epipolar_costs[(camera_num, k)][point_index] for camera_num, point_index in hypothesis.items()]
+        candidates = set(member_costs[0]).intersection(*member_costs[1:])
+        if len(candidates) != 0:
+            hypothesis[k] = min(candidates, key=lambda point_index: sum(costs[point_index] for costs in member_costs))
+
+    return hypothesis
+
+
+def load_marker_templates(file_name):
+    # rigid LED layouts per drone, marker positions in meters around the point reported as the drone position.
+    # heading_markers [a, b] give the heading direction markers[a] - markers[b], symmetric_heading folds it into +-90 degrees.
+    # orientation optionally requires a marker to sit above (or not) the drone position along a world axis
+    with open(file_name) as f:
+        marker_templates = json.load(f)
+
+    if len(marker_templates) == 0:
+        raise ValueError(f"{file_name} has no marker templates")
+    for marker_template in marker_templates:
+        # the drone count is the largest drone_index + 1, see index.py
+        if not isinstance(marker_template.get("drone_index"), int) or marker_template["drone_index"] < 0:
+            raise ValueError(f"{file_name}: drone_index must be a non-negative integer, got {marker_template.get('drone_index')!r}")
+        marker_template["markers"] = np.array(marker_template["markers"], dtype=np.float64)
+        marker_template["distances"] = distance.squareform(distance.pdist(marker_template["markers"]))
+        marker_template.setdefault("tolerance", 0.025)
+        marker_template.setdefault("symmetric_heading", False)
+        marker_template.setdefault("orientation", None)
+
+    return marker_templates
+
+
+def locate_objects(object_points, errors, marker_templates=None, timestamps=None):
+    if marker_templates is None:
+        marker_templates = Cameras.instance().marker_templates
+
+    object_points = np.array(object_points, dtype=np.float64).reshape((-1, 3))
+    errors = np.array(errors, dtype=np.float64)
+    timestamps = None if timestamps is None else np.array(timestamps, dtype=np.float64)
+    if len(object_points) < 2:
+        return []
+
+    distance_matrix = distance.squareform(distance.pdist(object_points))
+
+    # every placement of every template, best fitting first, each object point is used by at most one object
+    fits = []
+    for marker_template in marker_templates:
+        point_groups = match_marker_template(distance_matrix, marker_template["distances"], marker_template["tolerance"])
+        if len(point_groups) == 0:
             continue
 
-        errors_i = calculate_reprojection_errors(image_points, object_points_i, camera_poses)
-
-        object_points.append(object_points_i[np.argmin(errors_i)])
-        errors.append(np.min(errors_i))
+        Rs, ts, residuals = fit_rigid_transforms(marker_template["markers"], object_points[point_groups])
 
-    return np.array(errors), np.array(object_points), frames
+        orientation = marker_template["orientation"]
+        if orientation is not None:
+            offsets = object_points[point_groups[:, orientation["marker"]], orientation["axis"]] - ts[:, orientation["axis"]]
+            is_oriented = offsets > 0 if orientation["above"] else offsets <= 0
+            point_groups, Rs, ts, residuals = point_groups[is_oriented], Rs[is_oriented], ts[is_oriented], residuals[is_oriented]
 
+        fits += [(residual, marker_template, point_group, R, t) for residual, point_group, R, t in zip(residuals, point_groups, Rs, ts)]
 
-def locate_objects(object_points, errors):
-    dist1 = 0.095
-    dist2 = 0.15
+    fits.sort(key=lambda fit: fit[0])
 
-    distance_matrix = np.zeros((object_points.shape[0], object_points.shape[0]))
-    already_matched_points = []
     objects = []
+    used_points = np.zeros(len(object_points), dtype=bool)
+    for _, marker_template, point_group, R, t in fits:
+        if np.any(used_points[point_group]):
+            continue
+        used_points[point_group] = True
 
-    for i in range(0, object_points.shape[0]):
-        for j in range(0, object_points.shape[0]):
-            distance_matrix[i,j] = np.sqrt(np.sum((object_points[i] - object_points[j])**2))
+        a, b = marker_template["heading_markers"]
+        heading_vec = R @ (marker_template["markers"][a] - marker_template["markers"][b])
+        heading = np.arctan2(heading_vec[1], heading_vec[0])
+
+        if marker_template["symmetric_heading"]:
+            heading = heading - np.pi if heading > np.pi/2 else heading
+            heading = heading + np.pi if heading < -np.pi/2 else heading
+
+        object = {
+            "pos": t,
+            "heading": -heading,
+            "error": np.mean(errors[point_group]),
+            "droneIndex": marker_template["drone_index"]
+        }
+        if timestamps is not None:
+            object["timestamp"] = np.mean(timestamps[point_group])
+        objects.append(object)
 
-    for i in range(0, object_points.shape[0]):
-        if i in already_matched_points:
-            continue
-        
-        distance_deltas = np.abs(distance_matrix[i] - dist1)
-        num_matches = distance_deltas < 0.025
-        matches_index = np.where(distance_deltas < 0.025)[0]
-        if np.sum(num_matches) >= 2:
-            for possible_pair in cartesian_product(matches_index, matches_index):
-                pair_distance = np.sqrt(np.sum((object_points[possible_pair[0]] - object_points[possible_pair[1]])**2))
-                
-                # if the pair isnt the correct distance apart
-                if np.abs(pair_distance - dist2) > 0.025:
-                    continue
-
-                best_match_1_i = possible_pair[0]
-                best_match_2_i = possible_pair[1]
-
-                already_matched_points.append(i)
-                already_matched_points.append(best_match_1_i)
-                already_matched_points.append(best_match_2_i)
-
-                location = (object_points[best_match_1_i]+object_points[best_match_2_i])/2
-                error = np.mean([errors[i], errors[best_match_1_i], errors[best_match_2_i]])
-
-                heading_vec = object_points[best_match_1_i] - object_points[best_match_2_i]
-                heading_vec /= linalg.norm(heading_vec)
-                heading = np.arctan2(heading_vec[1], heading_vec[0])
-
-                heading = heading - np.pi if heading > np.pi/2 else heading
-                heading = heading + np.pi if heading < -np.pi/2 else heading
-
-                # determine drone index based on which side third light is on
-                drone_index = 0 if (object_points[i] - location)[1] > 0 else 1
-
-                objects.append({
-                    "pos": location,
-                    "heading": -heading,
-                    "error": error,
-                    "droneIndex": drone_index
-                })
-
-                break
-    
     return objects
 
 
+def match_marker_template(distance_matrix, template_distances, tolerance):
+    # (G, M) indices of every ordered group of object points whose pairwise distances match the template,
+    # grown one marker at a time by joining against the distance matrix
+    point_groups = np.arange(0, len(distance_matrix))[:, np.newaxis]
+    for k in range(1, len(template_distances)):
+        if len(point_groups) == 0:
+            break
+        is_match = np.all(np.abs(distance_matrix[point_groups] - template_distances[:k, k, np.newaxis]) < tolerance, axis=1)
+        is_match[np.arange(0, len(point_groups))[:, np.newaxis], point_groups] = False
+        group_indices, point_indices = np.nonzero(is_match)
+        point_groups = np.column_stack([point_groups[group_indices], point_indices])
+
+    return point_groups.reshape((-1, len(template_distances)))
+
+
+def fit_rigid_transforms(template_markers, point_groups):
+    # Kabsch fit of the template onto each (M, 3) group of points, point ~= R @ marker + t
+    template_centroid = np.mean(template_markers, axis=0)
+    point_centroids = np.mean(point_groups, axis=1)
+    H = np.einsum("mi,gmj->gij", template_markers - template_centroid, point_groups - point_centroids[:, np.newaxis])
+
+    U, _, Vt = np.linalg.svd(H)
+    V = np.transpose(Vt, (0, 2, 1))
+    D = np.tile(np.eye(3), (len(H), 1, 1))
+    D[:, 2, 2] = np.sign(np.linalg.det(V @ np.transpose(U, (0, 2, 1))))
+    Rs = V @ D @ np.transpose(U, (0, 2, 1))
+    ts = point_centroids - Rs @ template_centroid
+
+    fitted_points = np.einsum("gij,mj->gmi", Rs, template_markers) + ts[:, np.newaxis]
+    residuals = np.sqrt(np.mean(np.sum((fitted_points - point_groups)**2, axis=2), axis=1))
+
+    return Rs, ts, residuals
+
+
+def merge_rois(rois):
+    # merge overlapping (x0, y0, x1, y1) windows so no part of the image is searched twice
+    merged = []
+    for roi in rois:
+        if roi[2] <= roi[0] or roi[3] <= roi[1]:
+            continue
+        i = 0
+        while i < len(merged):
+            other = merged[i]
+            if roi[0] < other[2] and other[0] < roi[2] and roi[1] < other[3] and other[1] < roi[3]:
+                roi = [min(roi[0], other[0]), min(roi[1], other[1]), max(roi[2], other[2]), max(roi[3], other[3])]
+                merged.pop(i)
+                i = 0
+            else:
+                i += 1
+        merged.append(roi)
+
+    return merged
+
+
 def numpy_fillna(data):
     data = np.array(data, dtype=object)
     # Get lengths of each row of data
@@ -494,10 +1111,20 @@ def numpy_fillna(data):
     return out
         
 
+def draw_dots(img, dots):
+    for x0, y0, x1, y1 in dots["rois"] or []:
+        cv.rectangle(img, (x0, y0), (x1-1, y1-1), (255,100,0), 1)
+    for (center_x, center_y), (x, y, w, h) in zip(dots["centroids"], dots["bounding_boxes"]):
+        cv.rectangle(img, (int(x), int(y)), (int(x+w-1), int(y+h-1)), (0,255,0), 1)
+        cv.putText(img, f'({center_x:.1f}, {center_y:.1f})', (int(center_x),int(center_y) - 15), cv.FONT_HERSHEY_SIMPLEX, 0.3, (100,255,100), 1)
+        cv.circle(img, (int(center_x),int(center_y)), 1, (100,255,100), -1)
+    return img
+
+
 def drawlines(img1,lines):
     r,c,_ = img1.shape
-    for r in lines:
-        color = tuple(np.random.randint(0,255,3).tolist())
+    for i, r in enumerate(lines):
+        color = EPIPOLAR_LINE_COLORS[i % len(EPIPOLAR_LINE_COLORS)]
         x0,y0 = map(int, [0, -r[2]/r[1] ])
         x1,y1 = map(int, [c, -(r[2]+r[0]*c)/r[1] ])
         img1 = cv.line(img1, (x0,y0), (x1,y1), color,1)
@@ -523,15 +1150,109 @@ def make_square(img):
     return new_img
 
 
+def find_blobs(grey, threshold, min_area=1, max_area=None, binary=None, labels=None):
+    # returns sub-pixel intensity weighted centroids (N,2), areas (N,) and bounding boxes (N,4) as x, y, w, h
+    # binary and labels are optional preallocated outputs the size of grey
+    binary = cv.threshold(grey, threshold, 255, cv.THRESH_BINARY, dst=binary)[1]
+    num_labels, labels, stats, _ = cv.connectedComponentsWithStats(binary, labels=labels, connectivity=8, ltype=cv.CV_32S)
+
+    areas = stats[1:, cv.CC_STAT_AREA]
+    bounding_boxes = stats[1:, :4]
+    keep = areas >= min_area
+    if max_area is not None:
+        keep &= areas <= max_area
+    if num_labels <= 1 or not np.any(keep):
+        return np.empty((0, 2)), np.empty((0,), dtype=areas.dtype), np.empty((0, 4), dtype=bounding_boxes.dtype)
+
+    # only the foreground pixels are visited, the per blob sums come out of one bincount each
+    pixels = cv.findNonZero(binary).reshape((-1, 2))
+    xs, ys = pixels[:, 0], pixels[:, 1]
+    pixel_labels = labels[ys, xs]
+    weights = grey[ys, xs].astype(np.float64)
+    total_weights = np.bincount(pixel_labels, weights, minlength=num_labels)[1:]
+    centroids = np.stack([
+        np.bincount(pixel_labels, weights*xs, minlength=num_labels)[1:],
+        np.bincount(pixel_labels, weights*ys, minlength=num_labels)[1:]
+    ], axis=1) / total_weights[:, np.newaxis]
+
+    return centroids[keep], areas[keep], bounding_boxes[keep]
+
+
+# fuses np.rot90, make_square and cv.undistort into one cv.remap lookup from the raw frame
+def build_camera_remap(intrinsic_matrix, distortion_coef, rotation, frame_shape, feather_pixels=8, channels=3):
+    height, width = frame_shape[:2]
+    rotation = rotation % 4
+    rotated_height, rotated_width = (width, height) if rotation % 2 else (height, width)
+    size = max(rotated_height, rotated_width)
+    ax, ay = (size - rotated_width)//2, (size - rotated_height)//2
+
+    # position in the padded square image that each undistorted pixel samples from
+    map_x, map_y = cv.initUndistortRectifyMap(intrinsic_matrix, distortion_coef, None, intrinsic_matrix, (size, size), cv.CV_32FC1)
+    rotated_x = map_x - ax
+    rotated_y = map_y - ay
+
+    # make_square feathers the image edge into the padding, replicate the edge pixels and fade them out
+    weight = np.ones((size, size), dtype=np.float32)
+    if ay > 0:
+        outside = np.maximum(np.maximum(-rotated_y, rotated_y - (rotated_height - 1)), 0)
+        weight *= np.clip(1 - outside / feather_pixels, 0, 1)
+        rotated_y = np.clip(rotated_y, 0, rotated_height - 1)
+    if ax > 0:
+        outside = np.maximum(np.maximum(-rotated_x, rotated_x - (rotated_width - 1)), 0)
+        weight *= np.clip(1 - outside / feather_pixels, 0, 1)
+        rotated_x = np.clip(rotated_x, 0, rotated_width - 1)
+
+    # undo np.rot90
+    if rotation == 0:
+        source_x, source_y = rotated_x, rotated_y
+    elif rotation == 1:
+        source_x, source_y = width - 1 - rotated_y, rotated_x
+    elif rotation == 2:
+        source_x, source_y = width - 1 - rotated_x, height - 1 - rotated_y
+    else:
+        source_x, source_y = rotated_y, height - 1 - rotated_x
+
+    # fully faded pixels sample outside the frame and come out black
+    source_x = np.where(weight == 0, -10, source_x).astype(np.float32)
+    source_y = np.where(weight == 0, -10, source_y).astype(np.float32)
+    map1, map2 = cv.convertMaps(source_x, source_y, cv.CV_16SC2)
+
+    # the partially faded pixels only cover a few rows, store them as bands so the fade is cheap to apply
+    feather_bands = []
+    feather_rows = np.where(np.any((weight > 0) & (weight < 1), axis=1))[0]
+    if len(feather_rows) != 0:
+        band_starts = np.concatenate([[0], np.where(np.diff(feather_rows) != 1)[0] + 1])
+        band_ends = np.concatenate([band_starts[1:], [len(feather_rows)]])
+        for start, end in zip(band_starts, band_ends):
+            y0, y1 = int(feather_rows[start]), int(feather_rows[end-1]) + 1
+            band_weight = weight[y0:y1]
+            if channels > 1:
+                band_weight = np.repeat(band_weight[:, :, np.newaxis], channels, axis=2)
+            feather_bands.append((y0, y1, band_weight))
+
+    return {
+        "frame_shape": (height, width),
+        "map1": map1,
+        "map2": map2,
+        "feather_bands": feather_bands
+    }
+
+
+def apply_camera_remap(frame, camera_remap, dst=None):
+    frame = cv.remap(frame, camera_remap["map1"], camera_remap["map2"], cv.INTER_LINEAR, dst=dst, borderMode=cv.BORDER_CONSTANT)
+    for y0, y1, band_weight in camera_remap["feather_bands"]:
+        band = frame[y0:y1]
+        cv.multiply(band, band_weight, dst=band, dtype=cv.CV_8U)
+
+    return frame
+
+
 def camera_pose_to_serializable(camera_poses):
     for i in range(0, len(camera_poses)):
         camera_poses[i] = {k: v.tolist() for (k, v) in camera_poses[i].items()}
 
     return camera_poses
 
-def cartesian_product(x, y):
-    return np.array([[x0, y0] for x0 in x for y0 in y])
-
 def add_white_border(image, border_size):
     height, width = image.shape[:2]
     bordered_image = cv.copyMakeBorder(image, border_size, border_size, border_size, border_size, cv.BORDER_CONSTANT, value=[255, 255, 255])
@@ -1,14 +1,18 @@
-from helpers import camera_pose_to_serializable, calculate_reprojection_errors, bundle_adjustment, Cameras, triangulate_points
+from helpers import Cameras
 from KalmanFilter import KalmanFilter
+from TrackingLoop import TrackingLoop
+from MjpegBroadcaster import MjpegBroadcaster
+from CalibrationJobRunner import CalibrationJobRunner
+from CalibrationRefiner import CalibrationRefiner
 
 from flask import Flask, Response, request
-import cv2 as cv
 import numpy as np
 import json
 from scipy import linalg
 
 from flask_socketio import SocketIO
 import copy
+import os
 import time
 import serial
 import threading
@@ -26,39 +30,61 @@ socketio = SocketIO(app, cors_allowed_origins='*')
 
 cameras_init = False
 
-num_objects = 2
+num_objects = None # one per drone_index in marker-templates.json, set when the tracking loop starts
 
-@app.route("/api/camera-stream")
-def camera_stream():
+tracking_loop = None
+mjpeg_broadcaster = None
+
+def start_tracking_loop():
+    global cameras_init, tracking_loop, mjpeg_broadcaster, num_objects
     cameras = Cameras.instance()
+    num_objects = max(marker_template["drone_index"] for marker_template in cameras.marker_templates) + 1
     cameras.set_socketio(socketio)
     # cameras.set_ser(ser)
     # cameras.set_serialLock(serialLock)
     cameras.set_num_objects(num_objects)
-    
-    def gen(cameras):
-        frequency = 150
-        loop_interval = 1.0 / frequency
-        last_run_time = 0
-        i = 0
-
-        while True:
-            time_now = time.time()
-
-            i = (i+1)%10
-            if i == 0:
-                socketio.emit("fps", {"fps": round(1/(time_now - last_run_time))})
 
-            if time_now - last_run_time < loop_interval:
-                time.sleep(last_run_time - time_now + loop_interval)
-            last_run_time = time.time()
-            frames = cameras.get_frames()
-            jpeg_frame = cv.imencode('.jpg', frames)[1].tostring()
+    # tracking runs at the camera frame rate whether or not anyone is watching the stream
+    tracking_loop = TrackingLoop(cameras, socketio, fps=cameras.frame_source.read_rate())
+    tracking_loop.start()
+    mjpeg_broadcaster = MjpegBroadcaster(tracking_loop)
+    cameras_init = True
 
-            yield (b'--frame\r\n'
-                b'Content-Type: image/jpeg\r\n\r\n' + jpeg_frame + b'\r\n')
 
-    return Response(gen(cameras), mimetype='multipart/x-mixed-replace; boundary=frame')
+@app.route("/api/camera-stream")
+def camera_stream():
+    if Cameras.instance().headless:
+        return Response("The camera preview is disabled in headless mode", status=404)
+
+    # optional per client limits, e.g. /api/camera-stream?fps=15&scale=0.5&quality=70
+    max_fps = request.args.get("fps", type=float)
+    scale = request.args.get("scale", 1.0, type=float)
+    quality = request.args.get("quality", 95, type=int)
+    if not 0 < scale <= 1:
+        scale = 1.0
+    quality = min(max(quality, 1), 100)
+
+    def gen():
+        jpeg_id = None
+
+        subscriber = mjpeg_broadcaster.subscribe(max_fps, scale, quality)
+        try:
+            while True:
+                jpeg_id, jpeg_frame = subscriber.wait_for_jpeg(jpeg_id)
+                if jpeg_frame is None:
+                    continue
+
+                yield (b'--frame\r\n'
+                    b'Content-Type: image/jpeg\r\n\r\n' + jpeg_frame + b'\r\n')
+        finally:
+            mjpeg_broadcaster.unsubscribe(subscriber)
+
+    return Response(gen(), mimetype='multipart/x-mixed-replace; boundary=frame')
+
+@app.route("/api/latency")
+def latency_api():
+    # per stage p50/p95/p99 and histograms in milliseconds, the same as the "latency" socket event
+    return json.dumps(Cameras.instance().latency_tracer.summary())
 
 @app.route("/api/trajectory-planning", methods=["POST"])
 def trajectory_planning_api():
@@ -123,7 +149,8 @@ def arm_drone(data):
             "armed": data["droneArmed"][droneIndex],
         }
         with serialLock:
-            ser.write(f"{str(droneIndex)}{json.dumps(serial_data)}".encode('utf-8'))
+            # ser.write(f"{str(droneIndex)}{json.dumps(serial_data)}".encode('utf-8'))
+            pass
         
         time.sleep(0.01)
 
@@ -214,6 +241,8 @@ def change_camera_settings(data):
     cameras = Cameras.instance()
     
     cameras.edit_settings(data["exposure"], data["gain"])
+    if "blobMinArea" in data or "blobMaxArea" in data:
+        cameras.set_blob_area_limits(data.get("blobMinArea", cameras.blob_min_area), data.get("blobMaxArea", cameras.blob_max_area))
 
 @socketio.on("capture-points")
 def capture_points(data):
@@ -229,52 +258,45 @@ def capture_points(data):
 @socketio.on("calculate-camera-pose")
 def calculate_camera_pose(data):
     cameras = Cameras.instance()
-    image_points = np.array(data["cameraPoints"])
-    image_points_t = image_points.transpose((1, 0, 2))
-
-    camera_poses = [{
-        "R": np.eye(3),
-        "t": np.array([[0],[0],[0]], dtype=np.float32)
-    }]
-    for camera_i in range(0, cameras.num_cameras-1):
-        camera1_image_points = image_points_t[camera_i]
-        camera2_image_points = image_points_t[camera_i+1]
-        not_none_indicies = np.where(np.all(camera1_image_points != None, axis=1) & np.all(camera2_image_points != None, axis=1))[0]
-        camera1_image_points = np.take(camera1_image_points, not_none_indicies, axis=0).astype(np.float32)
-        camera2_image_points = np.take(camera2_image_points, not_none_indicies, axis=0).astype(np.float32)
+    intrinsic_matrices = [cameras.get_camera_params(i)["intrinsic_matrix"].tolist() for i in range(0, cameras.num_cameras)]
+    # points are detected in the remapped frames, not in frames of twice the principal point
+    image_sizes = [[cameras.camera_remaps[i]["map1"].shape[1], cameras.camera_remaps[i]["map1"].shape[0]] for i in range(0, cameras.num_cameras)]
 
-        F, _ = cv.findFundamentalMat(camera1_image_points, camera2_image_points, cv.FM_RANSAC, 1, 0.99999)
-        E = cv.sfm.essentialFromFundamental(F, cameras.get_camera_params(0)["intrinsic_matrix"], cameras.get_camera_params(1)["intrinsic_matrix"])
-        possible_Rs, possible_ts = cv.sfm.motionFromEssential(E)
+    # solves in a separate process, progress and the result arrive through emit_calibration_job_event.
+    # Long captures are subsampled to targetSampleCount evenly spread samples before bundle adjustment
+    calibration_job_runner.start(data["cameraPoints"], intrinsic_matrices, image_sizes, data.get("targetSampleCount", 1000))
 
-        R = None
-        t = None
-        max_points_infront_of_camera = 0
-        for i in range(0, 4):
-            object_points = triangulate_points(np.hstack([np.expand_dims(camera1_image_points, axis=1), np.expand_dims(camera2_image_points, axis=1)]), np.concatenate([[camera_poses[-1]], [{"R": possible_Rs[i], "t": possible_ts[i]}]]))
-            object_points_camera_coordinate_frame = np.array([possible_Rs[i].T @ object_point for object_point in object_points])
+@socketio.on("cancel-calibration")
+def cancel_calibration(data):
+    calibration_job_runner.cancel(data.get("jobId") if data else None)
 
-            points_infront_of_camera = np.sum(object_points[:,2] > 0) + np.sum(object_points_camera_coordinate_frame[:,2] > 0)
+def emit_calibration_job_event(event):
+    if "camera_poses" in event:
+        socketio.emit("camera-pose", {"camera_poses": event.pop("camera_poses")})
 
-            if points_infront_of_camera > max_points_infront_of_camera:
-                max_points_infront_of_camera = points_infront_of_camera
-                R = possible_Rs[i]
-                t = possible_ts[i]
+    socketio.emit("calibration-job", event)
 
-        R = R @ camera_poses[-1]["R"]
-        t = camera_poses[-1]["t"] + (camera_poses[-1]["R"] @ t)
+calibration_job_runner = CalibrationJobRunner(emit_calibration_job_event, cpu_budget=int(os.environ.get("MOCAP_CALIBRATION_CPUS", 1)))
 
-        camera_poses.append({
-            "R": R,
-            "t": t
-        })
-
-    camera_poses = bundle_adjustment(image_points, camera_poses, socketio)
+@socketio.on("calibration-refiner")
+def start_or_stop_calibration_refiner(data):
+    cameras = Cameras.instance()
+    start_or_stop = data["startOrStop"]
 
-    object_points = triangulate_points(image_points, camera_poses)
-    error = np.mean(calculate_reprojection_errors(image_points, object_points, camera_poses))
+    if (start_or_stop == "start"):
+        if cameras.calibration_refiner is None:
+            calibration_refiner = CalibrationRefiner(cameras, emit_refined_camera_poses)
+            cameras.set_calibration_refiner(calibration_refiner)
+            calibration_refiner.start()
+        return
+    elif (start_or_stop == "stop"):
+        if cameras.calibration_refiner is not None:
+            cameras.calibration_refiner.stop()
+            cameras.set_calibration_refiner(None)
 
-    socketio.emit("camera-pose", {"camera_poses": camera_pose_to_serializable(camera_poses)})
+def emit_refined_camera_poses(camera_poses, report):
+    socketio.emit("camera-pose", {"camera_poses": camera_poses})
+    socketio.emit("calibration-refiner", report)
 
 @socketio.on("locate-objects")
 def start_or_stop_locating_objects(data):
@@ -287,6 +309,17 @@ def start_or_stop_locating_objects(data):
     elif (start_or_stop == "stop"):
         cameras.stop_locating_objects()
 
+@socketio.on("roi-detection")
+def start_or_stop_roi_detection(data):
+    cameras = Cameras.instance()
+    start_or_stop = data["startOrStop"]
+
+    if (start_or_stop == "start"):
+        cameras.start_roi_detection()
+        return
+    elif (start_or_stop == "stop"):
+        cameras.stop_roi_detection()
+
 @socketio.on("determine-scale")
 def determine_scale(data):
     object_points = data["objectPoints"]
@@ -323,4 +356,8 @@ def live_mocap(data):
 
 
 if __name__ == '__main__':
-    socketio.run(app, port=3001, debug=True)
\ No newline at end of file
+    debug = True
+    # with debug the reloader imports this file in a watcher process too, only the serving process opens the cameras
+    if not debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_tracking_loop()
+    socketio.run(app, port=3001, debug=debug)
\ No newline at end of file
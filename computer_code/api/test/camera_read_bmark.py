@@ -0,0 +1,61 @@
+# Profiles Cameras._camera_read without camera hardware
+# usage: python test/camera_read_bmark.py [recording.avi]
+# with a recording the frames are replayed from camera_save_video.py output, otherwise markers are rendered synthetically
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from FrameSource import SyntheticFrameSource, VideoFileFrameSource, ring_camera_poses, circling_drone_markers
+from helpers import Cameras
+
+
+class NullSocketIO:
+    def emit(self, *args, **kwargs):
+        pass
+
+
+def make_frame_source(cameras):
+    if len(sys.argv) > 1:
+        return VideoFileFrameSource.from_recording(sys.argv[1], speed=0)
+    return SyntheticFrameSource(cameras.camera_params, ring_camera_poses(len(cameras.camera_params)), circling_drone_markers, realtime=False)
+
+
+def run_test(cameras, num_workers, capture_points, preview, num_frames=200):
+    cameras.set_num_workers(num_workers)
+    cameras.is_preview_enabled = preview
+    if capture_points:
+        cameras.start_capturing_points()
+    else:
+        cameras.stop_capturing_points()
+
+    frame_times = []
+    for _ in range(0, num_frames):
+        start_time = time.perf_counter()
+        cameras.get_frames()
+        frame_times.append(time.perf_counter() - start_time)
+
+    frame_times = np.array(frame_times[10:]) * 1000
+    return {
+        'mean_ms': np.mean(frame_times),
+        'p95_ms': np.percentile(frame_times, 95),
+        'max_ms': np.max(frame_times)
+    }
+
+
+if __name__ == "__main__":
+    os.environ["MOCAP_FRAME_SOURCE"] = "synthetic"
+    cameras = Cameras.instance()
+    cameras.set_socketio(NullSocketIO())
+    cameras.set_frame_source(make_frame_source(cameras))
+
+    print(f"\n=== _camera_read benchmark, {cameras.num_cameras} cameras ===")
+    print("\nWorkers | Capture points | Preview | Mean     | p95      | Max")
+    print("-" * 65)
+    for num_workers in [1, cameras.num_cameras]:
+        for capture_points in [False, True]:
+            for preview in [True, False]:
+                r = run_test(cameras, num_workers, capture_points, preview)
+                print(f"{num_workers:7d} | {str(capture_points):14} | {str(preview):7} | {r['mean_ms']:6.2f}ms | {r['p95_ms']:6.2f}ms | {r['max_ms']:6.2f}ms")
@@ -0,0 +1,88 @@
+# Checks that EpipolarIndex finds exactly the points a brute force distance test finds, and that get_epipolar_costs
+# gives the same matches through the index as through the dense comparison, then times both
+# usage: python test/epipolar_index_check.py
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from EpipolarIndex import EpipolarIndex
+from Calibration import Calibration
+from FrameSource import ring_camera_poses
+from helpers import get_epipolar_costs
+
+
+INTRINSIC_MATRIX = np.array([[500, 0, 320], [0, 500, 240], [0, 0, 1]], dtype=np.float64)
+
+
+def check_index(rng, num_trials=300, num_queries=20):
+    # finite epipoles inside and far outside the image, and epipoles at infinity
+    for trial in range(0, num_trials):
+        points = rng.uniform(0, 640, size=(rng.integers(0, 80), 2))
+        if trial % 3 == 0:
+            epipole = np.r_[rng.normal(size=2), 0.0]
+        elif trial % 3 == 1:
+            epipole = np.r_[rng.uniform(0, 640, 2), 1.0]
+        else:
+            epipole = np.r_[rng.uniform(-3000, 3000, 2), 1.0]
+        tolerance = rng.uniform(1, 15)
+
+        epipolar_index = EpipolarIndex(points, epipole, tolerance)
+        for _ in range(0, num_queries):
+            line = np.cross(epipole, np.r_[rng.uniform(0, 640, 2), 1])
+            line /= np.hypot(line[0], line[1])
+            indices, _ = epipolar_index.query(line)
+            expected_indices = np.nonzero(np.abs(points @ line[:2] + line[2]) < tolerance)[0]
+            assert set(indices.tolist()) == set(expected_indices.tolist()), f"trial {trial} differs from brute force"
+
+
+def make_camera_points(rng, calibration, num_points):
+    # projections of shared 3D points plus as many uncorrelated points, so both matches and misses are tested
+    object_points = rng.uniform(-0.8, 0.8, size=(num_points // 2, 3)) + [0, 0, 1]
+    camera_points = []
+    for P in calibration.Ps:
+        image_points = np.c_[object_points, np.ones(len(object_points))] @ P.T
+        image_points = image_points[:, :2] / image_points[:, 2:] + rng.normal(size=(len(object_points), 2))
+        camera_points.append(np.r_[image_points, rng.uniform(0, 480, size=(num_points - len(object_points), 2))])
+
+    return camera_points
+
+
+def check_costs(rng, calibration, num_points, epipolar_tolerance=5):
+    camera_points = make_camera_points(rng, calibration, num_points)
+
+    start_time = time.perf_counter()
+    dense_costs = get_epipolar_costs(camera_points, calibration, epipolar_tolerance, epipolar_index_min_pairs=np.inf)
+    dense_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    index_costs = get_epipolar_costs(camera_points, calibration, epipolar_tolerance, epipolar_index_min_pairs=0)
+    index_time = time.perf_counter() - start_time
+
+    assert dense_costs.keys() == index_costs.keys()
+    num_matches = 0
+    for camera_pair in dense_costs:
+        for dense_point_costs, index_point_costs in zip(dense_costs[camera_pair], index_costs[camera_pair]):
+            assert dense_point_costs.keys() == index_point_costs.keys(), f"camera pair {camera_pair} matches differ"
+            assert all(np.isclose(dense_point_costs[b], index_point_costs[b]) for b in dense_point_costs)
+            num_matches += len(dense_point_costs)
+
+    return num_matches, dense_time, index_time
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+
+    check_index(rng)
+    print("EpipolarIndex matches brute force")
+
+    calibration = Calibration([INTRINSIC_MATRIX] * 4, ring_camera_poses(4))
+    print(f"\n=== get_epipolar_costs, {calibration.num_cameras} cameras ===")
+    print("\nPoints per camera | Matches | Dense     | Index")
+    print("-" * 50)
+    for num_points in [30, 300, 1000]:
+        num_matches, dense_time, index_time = check_costs(rng, calibration, num_points)
+        print(f"{num_points:17} | {num_matches:7} | {dense_time*1000:6.1f} ms | {index_time*1000:6.1f} ms")
+    print("\nIndex matches are identical to the dense comparison")
@@ -0,0 +1,80 @@
+# Checks that the KalmanFilter bank predicts and corrects like one cv.KalmanFilter per drone with the same matrices,
+# and times both
+# usage: python test/kalman_filter_check.py
+import os
+import sys
+import time
+import cv2 as cv
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from KalmanFilter import KalmanFilter
+
+
+def make_cv_kalmans(kalman_filter):
+    # the per drone filters the bank replaced, in float32 like before
+    kalmans = []
+    for _ in range(0, kalman_filter.num_objects):
+        kalman = cv.KalmanFilter(9, 6)
+        kalman.measurementMatrix = np.eye(6, 9, dtype=np.float32)
+        kalman.measurementNoiseCov = kalman_filter.measurement_noise_cov.astype(np.float32)
+        kalman.errorCovPost = np.zeros((9, 9), dtype=np.float32)
+        kalmans.append(kalman)
+
+    return kalmans
+
+
+def run(num_objects, num_frames, rng):
+    kalman_filter = KalmanFilter(num_objects)
+    kalmans = make_cv_kalmans(kalman_filter)
+
+    # drones on random smooth paths, every drone missing from some frames
+    phases = rng.uniform(0, 2*np.pi, size=(num_objects, 3))
+    initial_positions = np.sin(phases)
+    kalman_filter.initialize(np.arange(0, num_objects), initial_positions)
+    for kalman, position in zip(kalmans, initial_positions):
+        kalman.statePost = np.r_[position, np.zeros(6)].astype(np.float32).reshape((9, 1))
+
+    max_difference = 0
+    bank_time = 0
+    cv_time = 0
+    frame_time = 0
+    for _ in range(0, num_frames):
+        dt = kalman_filter.frame_period * rng.uniform(0.5, 3)
+        frame_time += dt
+        indices = np.nonzero(rng.uniform(size=num_objects) < 0.9)[0]
+        positions = np.sin(phases[indices] + frame_time) + rng.normal(scale=0.01, size=(len(indices), 3))
+        measurements = np.hstack((positions, np.cos(phases[indices] + frame_time)))
+
+        start_time = time.perf_counter()
+        transition_matrix, process_noise_cov = kalman_filter.transition(dt)
+        kalman_filter.predict(indices, transition_matrix, process_noise_cov)
+        kalman_filter.correct(indices, measurements)
+        bank_time += time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        for i, measurement in zip(indices, measurements):
+            kalmans[i].transitionMatrix = transition_matrix.astype(np.float32)
+            kalmans[i].processNoiseCov = process_noise_cov.astype(np.float32)
+            kalmans[i].predict()
+            kalmans[i].correct(measurement.astype(np.float32).reshape((6, 1)))
+        cv_time += time.perf_counter() - start_time
+
+        cv_states = np.array([kalmans[i].statePost[:, 0] for i in indices]).reshape((-1, 9))
+        max_difference = max(max_difference, np.max(np.abs(kalman_filter.states[indices] - cv_states), initial=0))
+
+    return max_difference, bank_time / num_frames, cv_time / num_frames
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+
+    print("Drones | Max state difference | Bank      | cv.KalmanFilter")
+    print("-" * 60)
+    for num_objects in [2, 10, 50]:
+        max_difference, bank_time, cv_time = run(num_objects, 600, rng)
+        print(f"{num_objects:6} | {max_difference:20.2e} | {bank_time*1000:6.3f} ms | {cv_time*1000:6.3f} ms")
+        # cv.KalmanFilter works in float32, so the bank can only match it to float32 precision
+        assert max_difference < 1e-4, "the filter bank differs from cv.KalmanFilter"
+    print("\nThe filter bank matches cv.KalmanFilter to float32 precision")